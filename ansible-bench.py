@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Andrew Savchenko (c) Apache 2.0
+# andrew@savchenko.net
+#
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+from argparse import ArgumentParser
+from statistics import median
+from tempfile import mkdtemp
+from time import perf_counter
+
+#
+# Setup arguments parser
+#
+parser = ArgumentParser(
+                       prog='ansible-bench',
+                       description='Times ansible-sanity and ansible-unifier against synthetic playbooks.'
+                       )
+parser.add_argument('-r', '--roles', default='10,100',
+                    help="Number of roles, comma-separated to measure several tree sizes")
+parser.add_argument('-v', '--variables', type=int, default=100, help="Variables per role")
+parser.add_argument('-t', '--tasks', type=int, default=20, help="Tasks per tasks file")
+parser.add_argument('-m', '--readme-rows', type=int, default=50, help="README.md variables table rows per role")
+parser.add_argument('-n', '--noise', type=int, default=100, help="Files under files/ per role")
+parser.add_argument('-i', '--iterations', type=int, default=3, help="Runs per case, median is recorded")
+parser.add_argument('-o', '--output', help="Write results to this .JSON file")
+parser.add_argument('--baseline', help="Results .JSON file to compare with")
+parser.add_argument('--threshold', type=float, default=20,
+                    help="Allowed slowdown or memory growth against the baseline, %%")
+parser.add_argument('--memory', action='store_true', help="Also trace peak memory of ansible-sanity, once per case")
+parser.add_argument('--keep', action='store_true', help="Keep generated trees")
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+sanity = os.path.join(here, 'ansible-sanity.py')
+unifier = os.path.join(here, 'ansible-unifier.py')
+
+
+#
+# Generate synthetic playbook with its roles
+#
+#   tree/
+#   ├── site.yml
+#   └── roles/
+#       └── role_N/
+#           ├── README.md
+#           ├── defaults/main.yml
+#           ├── vars/main.yml
+#           ├── tasks/main.yml
+#           ├── tasks/extra.yml
+#           └── files/[0-9]/*.txt
+#
+#   Values are picked to produce every kind of issue: playbook overwrites some
+#   defaults, misses some vars and mistypes others; README misses some vars.
+#
+VALUES = ["42", "19.1459", "'single'", '"double"', "yes", "[1, 2, 3]", "{'key': 'value'}", "\n  - One\n  - 2"]
+
+def generate_tasks(role_num, tasks):
+    lines = ['---']
+    for task_num in range(tasks):
+        if task_num % 10 == 9:
+            lines.append('- debug:\n    msg: "Nameless %s"' % task_num)
+            continue
+        lines.append('- name: "Task %s of role_%s"' % (task_num, role_num))
+        lines.append('  debug:\n    msg: "{{ var_%s_%s }}"' % (role_num, task_num))
+        if task_num % 5 == 0:
+            lines.append('  become: yes')
+        if task_num % 7 == 0:
+            lines.append('  become_user: root')
+        if task_num % 4 == 0:
+            lines.append('  when: enabled == no')
+    lines.append('- block:\n  - name: Inside of the block\n    debug:\n      var: ansible_env.HOME\n  when: True')
+    return '\n'.join(lines) + '\n'
+
+def generate_tree(tree, roles):
+    rnd = random.Random(roles)
+    pbook = ['---', '- hosts: all', '  tasks:']
+    for role_num in range(roles):
+        role_dir = os.path.join(tree, 'roles', 'role_%s' % role_num)
+        for d in ('defaults', 'vars', 'tasks', 'handlers'):
+            os.makedirs(os.path.join(role_dir, d))
+        role_vars = ['var_%s_%s' % (role_num, v) for v in range(args.variables)]
+        role_values = {var: rnd.choice(VALUES) for var in role_vars}
+        half = len(role_vars) // 2
+        with open(os.path.join(role_dir, 'vars', 'main.yml'), 'w') as f:
+            f.write('---\n' + ''.join('%s: %s\n' % (var, role_values[var]) for var in role_vars[:half]))
+        with open(os.path.join(role_dir, 'defaults', 'main.yml'), 'w') as f:
+            f.write('---\n' + ''.join('%s: %s\n' % (var, role_values[var]) for var in role_vars[half:]))
+        with open(os.path.join(role_dir, 'tasks', 'main.yml'), 'w') as f:
+            f.write(generate_tasks(role_num, args.tasks))
+        with open(os.path.join(role_dir, 'tasks', 'extra.yml'), 'w') as f:
+            f.write(generate_tasks(role_num, args.tasks))
+        with open(os.path.join(role_dir, 'handlers', 'main.yml'), 'w') as f:
+            f.write('---\n# handlers file for role_%s\n' % role_num)
+        with open(os.path.join(role_dir, 'README.md'), 'w') as f:
+            f.write('# role_%s\n\n## Role Variables\n\n' % role_num)
+            f.write('| Variable | Description | Default |\n|----------|-------------|---------|\n')
+            for var in (role_vars * (args.readme_rows // max(len(role_vars), 1) + 1))[:args.readme_rows]:
+                f.write('| %s | Generated | %s |\n' % (var, role_values[var].strip().split('\n')[0] or 'None'))
+        for noise_num in range(args.noise):
+            noise_dir = os.path.join(role_dir, 'files', str(noise_num % 10))
+            os.makedirs(noise_dir, exist_ok=True)
+            with open(os.path.join(noise_dir, '%s.txt' % noise_num), 'w') as f:
+                f.write('noise\n')
+        pbook.append('  - name: Import role_%s\n    import_role:\n      name: role_%s\n    vars:' % (role_num, role_num))
+        for var in role_vars:
+            if rnd.random() < 0.7:
+                value = role_values[var] if rnd.random() < 0.9 else rnd.choice(VALUES)
+                pbook.append('      %s: %s' % (var, value.replace('\n', '\n    ')))
+        pbook.append('      undeclared_%s: True' % role_num)
+    with open(os.path.join(tree, 'site.yml'), 'w') as f:
+        f.write('\n'.join(pbook) + '\n')
+
+
+#
+# Time the tools
+#
+#   A run that exits with anything but 0 would be timed as a fast one, hence
+#   the bench stops on it, keeping the tree to reproduce the failure with.
+#
+def run(cmd, cwd, **kwargs):
+    completed = subprocess.run(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=False, **kwargs)
+    if completed.returncode != 0:
+        print('ERROR: %s exited with %s in %s:' % (' '.join(cmd[1:]), completed.returncode, cwd))
+        print('\t%s' % completed.stderr.decode(errors='replace').strip().replace('\n', '\n\t'))
+        os._exit(1)
+    return completed
+
+def timed(cmd, cwd, prepare=None):
+    runs = []
+    for _ in range(args.iterations):
+        if prepare:
+            prepare()
+        started = perf_counter()
+        run(cmd, cwd)
+        runs.append(perf_counter() - started)
+    return {'median': median(runs), 'min': min(runs), 'runs': runs}
+
+def memory_peak(cmd, cwd):
+    # Peak of Python allocations, as traced by tracemalloc and reported by `--profile json`
+    completed = run(cmd + ['--profile', 'json'], cwd, env=dict(os.environ, PYTHONTRACEMALLOC='1'))
+    try:
+        return json.loads(completed.stderr)['memory_peak']
+    except (ValueError, KeyError):
+        return None
+
+def bench(roles):
+    tree = mkdtemp(prefix='ansible-bench-%s-' % roles)
+    generate_tree(tree, roles)
+    results = {}
+    memory = {}
+    for case, flags in (('consistency', ['-c']), ('become', ['-b']), ('both', ['-c', '-b'])):
+        # Cache of the tree, not the one of the user
+        sanity_cmd = [sys.executable, sanity, '-p', 'site.yml', '-q', '--cache-dir', '.ansible-sanity-cache'] + flags
+        if args.memory:
+            memory['sanity_%s' % case] = memory_peak(sanity_cmd + ['--no-cache'], tree)
+        results['sanity_%s_cold' % case] = timed(sanity_cmd + ['--no-cache'], tree)
+        run(sanity_cmd, tree)
+        results['sanity_%s_warm' % case] = timed(sanity_cmd, tree)
+    # Unifier rewrites files in place, hence a pristine copy for every cold run
+    pristine = os.path.join(tree, 'pristine')
+    shutil.copytree(os.path.join(tree, 'roles'), pristine)
+
+    def restore():
+        shutil.rmtree(os.path.join(tree, 'roles'))
+        shutil.copytree(pristine, os.path.join(tree, 'roles'))
+    unifier_cmd = [sys.executable, unifier, '-d', 'roles', '-q']
+    results['unifier_cold'] = timed(unifier_cmd + ['--no-cache'], tree, restore)
+    run(unifier_cmd, tree)
+    results['unifier_warm'] = timed(unifier_cmd, tree)
+    if args.keep:
+        print('Kept %s' % tree)
+    else:
+        shutil.rmtree(tree)
+    return results, memory
+
+
+params = {
+    'variables': args.variables,
+    'tasks': args.tasks,
+    'readme_rows': args.readme_rows,
+    'noise': args.noise,
+    'iterations': args.iterations,
+}
+report = {'python': sys.version.split()[0], 'params': params, 'results': {}, 'memory': {}}
+for roles in [int(r) for r in args.roles.split(',')]:
+    report['results'][str(roles)], report['memory'][str(roles)] = bench(roles)
+    for case, timing in report['results'][str(roles)].items():
+        print('%6s roles  %-26s %8.1fms' % (roles, case, timing['median'] * 1000))
+    for case, peak in report['memory'][str(roles)].items():
+        print('%6s roles  %-26s %8.1fMB' % (roles, case + '_peak', peak / 2 ** 20 if peak else float('nan')))
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+#
+# Compare with the baseline
+#
+if args.baseline:
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    if baseline['params'] != params:
+        print('WARNING: Baseline was recorded with different parameters: %s' % baseline['params'])
+    regressions = []
+    for roles, cases in report['results'].items():
+        for case, timing in cases.items():
+            if case in baseline['results'].get(roles, {}):
+                was = baseline['results'][roles][case]['median']
+                if timing['median'] > was * (1 + args.threshold / 100):
+                    regressions.append('%s roles, %s: %.1fms -> %.1fms (+%.0f%%)' % (
+                        roles, case, was * 1000, timing['median'] * 1000, (timing['median'] / was - 1) * 100
+                    ))
+    for roles, cases in report['memory'].items():
+        for case, peak in cases.items():
+            was = baseline.get('memory', {}).get(roles, {}).get(case)
+            if was and peak and peak > was * (1 + args.threshold / 100):
+                regressions.append('%s roles, %s peak: %.1fMB -> %.1fMB (+%.0f%%)' % (
+                    roles, case, was / 2 ** 20, peak / 2 ** 20, (peak / was - 1) * 100
+                ))
+    if regressions:
+        print('\nRegressions over %s%%:\n' % args.threshold)
+        for regression in regressions:
+            print('   - %s' % regression)
+        os._exit(1)
@@ -3,14 +3,35 @@
 # Andrew Savchenko (c) Apache 2.0
 # andrew@savchenko.net
 #
+import json
 import os
+import pickle
+import subprocess
+import sys
+import tracemalloc
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from cProfile import Profile
+from glob import glob
 from ast import literal_eval
-from itertools import chain
-from re import match
+from hashlib import sha1
+from itertools import chain, count, islice
+from multiprocessing import get_all_start_methods, get_context
+from pstats import Stats
+from tempfile import mkstemp
+from io import StringIO
+from re import DOTALL, compile as re_compile
+from time import perf_counter, sleep, time
 
-from yaml import safe_load as yaml_safe_load
-from yaml.scanner import ScannerError
+from yaml import YAMLError, compose_all as yaml_compose_all, load as yaml_load
+from yaml.events import (AliasEvent, CollectionStartEvent, DocumentStartEvent, MappingEndEvent, MappingStartEvent,
+                         ScalarEvent, SequenceStartEvent, StreamEndEvent)
+from yaml.nodes import MappingNode, ScalarNode, SequenceNode
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 #
 # Setup arguments parser
@@ -19,11 +40,42 @@ parser = ArgumentParser(
                        prog='ansible-sanity',
                        description='Sanity-checks between role, its playbooks and readme files.'
                        )
-parser.add_argument('-p', '--playbook', help="Path to the playbook .YML file")
+parser.add_argument('-p', '--playbook', nargs='+',
+                    help="Path to the playbook .YML file(s), directories or globs of them")
 parser.add_argument('-c', '--consistency', action='store_true', help="Check variables consistency")
 parser.add_argument('-b', '--become', action='store_true', help="Check that `become` has username defined")
+parser.add_argument('-u', '--usage', action='store_true',
+                    help="Check that role variables are used and that used variables are declared")
 parser.add_argument('-q', '--quiet', action='store_true', help="Output number of issues only")
+parser.add_argument('-f', '--format', choices=['text', 'jsonl', 'sarif'], default='text',
+                    help="Output issues as text, JSON Lines or SARIF, each role as soon as it is checked")
+parser.add_argument('-j', '--jobs', type=int, default=1, help="Check roles in N processes, 0 for one per CPU")
+parser.add_argument('--changed-since', metavar='REV',
+                    help="Check only roles changed since the git revision, and all roles of changed playbooks")
+parser.add_argument('--staged', action='store_true', help="Check only roles with changes staged for commit")
+parser.add_argument('--scan-depth', type=int, default=1,
+                    help="Levels of subdirectories of tasks/vars/defaults/meta to collect YAMLs from")
+parser.add_argument('-w', '--watch', action='store_true', help="Keep running, re-check roles on every change")
+parser.add_argument('--watch-interval', type=float, default=0.5, help="Seconds between polls for changes")
+parser.add_argument('--loader', choices=['fast', 'full'], default='fast',
+                    help="Scan only top-level keys of vars/defaults, or load them completely")
+parser.add_argument('--cache-dir',
+                    default=os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                         'ansible-sanity'),
+                    help="Directory of the parse cache, ~/.cache/ansible-sanity by default. Never point it to a "
+                         "directory others can write to")
+parser.add_argument('--no-cache', action='store_true', help="Parse every file, ignore and keep the cache intact")
+parser.add_argument('--profile', nargs='?', const='text', choices=['text', 'json'],
+                    help="Output timings and counters of every phase to stderr")
+parser.add_argument('--profile-top', type=int, default=10, help="Number of the slowest to parse files to profile")
+parser.add_argument('--profile-phase', metavar='PHASE',
+                    help="Output cProfile statistics of this phase, roles are checked serially",
+                    choices=['cache', 'playbooks', 'changed', 'inventory', 'scan', 'tasks', 'variables', 'usages',
+                             'issues', 'report'] + ['parse-' + f_type for f_type in (
+                                 'tasks', 'vars', 'defaults', 'readme', 'meta', 'inventory', 'usage', 'template')])
 args = parser.parse_args()
+if args.watch and args.format == 'sarif':
+    parser.error('--watch outputs changes of issues, these have no SARIF representation')
 
 
 #      +------------------------------------+----------------------------+
@@ -33,39 +85,66 @@ args = parser.parse_args()
 #      | become_user | defaults  | defaults | become_without_become-user |
 #      | module      | vars      | vars     | overwrites_defaults        |
 #      | name        | READMEs   | READMEs  | type_mismatch              |
-#      |             |           |          | tasks_without_names        |
-#      |             |           |          | in-readme_not-in-role      |
+#      | usages      | inventory | handlers | tasks_without_names        |
+#      |             |           | templates| in-readme_not-in-role      |
 #      |             |           |          | in-readme_not-in-pbook     |
 #      |             |           |          | in-role_not-in-readme      |
 #      |             |           |          | in-playbook_not-in-role    |
 #      |             |           |          | in-role_not-in-playbook    |
+#      |             |           |          | declared-but-unused        |
+#      |             |           |          | used-but-undeclared        |
 #      +-------------+-----------+----------+----------------------------+
 #
-collected: dict = {'playbook': {}, 'files': {}, 'roles': {}, 'issues': {}}
+#   playbooks: {playbook: {role: vars}}
+#   files:     {role path: {tasks|vars|defaults|readme: [file, ...]}}
+#   roles:     {role path: {tasks: ..., variables: ..., usages: ...}}
+#   issues:    {playbook: {role: {issue: [Issue, ...]}}}
+#   inventory: {playbook directory: {variable: [(file, type), ...]}}
+#
+#   Roles are keyed by path, hence shared between the playbooks next to each other.
+#
+collected: dict = {'playbooks': {}, 'files': {}, 'roles': {}, 'issues': {}, 'inventory': {}}
 
 
 #
 # Check user-supplied data
 #
-if args.playbook and args.playbook.endswith('.yml'):
-    if os.path.isfile(args.playbook):
-        pbook_dir = os.path.dirname(os.path.abspath(args.playbook))
+#   Each of `-p` is a playbook, a directory of playbooks or a glob
+#
+pbooks = []
+for pbook_arg in args.playbook or []:
+    if os.path.isdir(pbook_arg):
+        pbook_matches = sorted(os.path.join(pbook_arg, f) for f in os.listdir(pbook_arg))
+    elif os.path.isfile(pbook_arg):
+        pbook_matches = [pbook_arg]
     else:
-        raise Exception("ERROR: Unable to open %s" % args.playbook)
-else:
+        pbook_matches = sorted(glob(pbook_arg))
+        if not pbook_matches:
+            raise Exception("ERROR: Unable to open %s" % pbook_arg)
+    for pbook in pbook_matches:
+        if pbook.endswith('.yml') and os.path.isfile(pbook) and pbook not in pbooks:
+            pbooks.append(pbook)
+if not pbooks:
     parser.print_usage()
     os._exit(os.EX_NOINPUT)
 
 #
 # Fail gracefully
 #
-def noroles():
-    print('No roles to parse in %s' % args.playbook)
-    os._exit(os.EX_DATAERR)
+def noroles(pbook):
+    report_warning('No roles to parse in %s' % pbook)
+    if len(pbooks) == 1:
+        os._exit(os.EX_DATAERR)
 
-def badroles(exc):
-    print('Unable to parse %s:' % args.playbook)
-    print('\t%s' % exc[2])
+def badroles(pbook, exc):
+    report_warning('Unable to parse %s:\n\t%s' % (pbook, getattr(exc, 'problem', None) or exc))
+    # Of several playbooks, the rest are still checked
+    if len(pbooks) == 1:
+        os._exit(os.EX_DATAERR)
+
+def badgit(exc):
+    report_warning('Unable to list changed files with git:\n\t%s'
+                   % (exc.stderr.strip() if getattr(exc, 'stderr', None) else exc))
     os._exit(os.EX_DATAERR)
 
 def nothing_to_check():
@@ -73,174 +152,940 @@ def nothing_to_check():
     os._exit(os.EX_NOINPUT)
 
 
-if not args.consistency and not args.become:
+if not args.consistency and not args.become and not args.usage:
     nothing_to_check()
 
 
+#
+# Profile
+#
+#   Phases nest, `parse-*` are included in `tasks` and `variables` of roles
+#   they belong to. Times of the phases run by the pool are summed up over
+#   workers, hence may exceed the total.
+#
+#      +------------+-------------------------------------------+
+#      | Phase      | Covers                                    |
+#      |------------+-------------------------------------------|
+#      | cache      | loading and saving the parse cache        |
+#      | playbooks  | reading and parsing playbooks             |
+#      | changed    | listing changed files with git            |
+#      | inventory  | indexing group_vars and host_vars         |
+#      | scan       | collecting role files                     |
+#      | tasks      | collecting tasks data                     |
+#      | variables  | collecting vars, defaults and README data |
+#      | usages     | indexing variables used by the role       |
+#      | parse-*    | parsing a file of the kind, cache misses  |
+#      | issues     | finding issues                            |
+#      | report     | showing results                           |
+#      +------------+-------------------------------------------+
+#
+profile: dict = {
+    'started': perf_counter(),
+    'phases': {},                # phase: [seconds, calls]
+    'files': {},                 # file: seconds to parse
+    'bytes_read': 0,
+    'literal_eval_fallbacks': 0,
+    'dir_entries': 0,
+    'cache_hits': 0,
+    'cprofile': Profile() if args.profile_phase else None,
+}
+
+@contextmanager
+def phase(name):
+    if not args.profile and not args.profile_phase:
+        yield
+        return
+    if name == args.profile_phase:
+        profile['cprofile'].enable()
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        phase_total = profile['phases'].setdefault(name, [0.0, 0])
+        phase_total[0] += perf_counter() - started
+        phase_total[1] += 1
+        if name == args.profile_phase:
+            profile['cprofile'].disable()
+
+def profile_reset():
+    profile['phases'] = {}
+    profile['files'] = {}
+    for counter in ('bytes_read', 'literal_eval_fallbacks', 'dir_entries', 'cache_hits'):
+        profile[counter] = 0
+
+def profile_merge(role_profile):
+    for name, (seconds, calls) in role_profile['phases'].items():
+        phase_total = profile['phases'].setdefault(name, [0.0, 0])
+        phase_total[0] += seconds
+        phase_total[1] += calls
+    profile['files'].update(role_profile['files'])
+    for counter in ('bytes_read', 'literal_eval_fallbacks', 'dir_entries', 'cache_hits'):
+        profile[counter] += role_profile[counter]
+
+def show_profile():
+    slowest = sorted(profile['files'].items(), key=lambda f: f[1], reverse=True)[:args.profile_top]
+    counters = ('bytes_read', 'literal_eval_fallbacks', 'dir_entries', 'cache_hits')
+    if tracemalloc.is_tracing():
+        # Started with PYTHONTRACEMALLOC=1, peak of this process only
+        profile['memory_peak'] = tracemalloc.get_traced_memory()[1]
+        counters += ('memory_peak',)
+    if args.profile == 'json':
+        json.dump({
+            'total': perf_counter() - profile['started'],
+            'phases': {name: {'seconds': p[0], 'calls': p[1]} for name, p in profile['phases'].items()},
+            'slowest_files': [{'file': f, 'seconds': seconds} for f, seconds in slowest],
+            'parsed_files': len(profile['files']),
+            **{counter: profile[counter] for counter in counters}
+        }, sys.stderr, indent=2)
+        print(file=sys.stderr)
+    elif args.profile == 'text':
+        stderr = ['\n%-24s %8s %12s' % ('Phase', 'Calls', 'Seconds')]
+        for name, (seconds, calls) in profile['phases'].items():
+            stderr.append('%-24s %8s %12.4f' % (name, calls, seconds))
+        stderr.append('%-24s %8s %12.4f' % ('total', '', perf_counter() - profile['started']))
+        stderr.append('\nSlowest of %s parsed files:\n' % len(profile['files']))
+        for f, seconds in slowest:
+            stderr.append('%12.4f  %s' % (seconds, f))
+        stderr.append('')
+        for counter in counters:
+            stderr.append('%-24s %21s' % (counter.replace('_', ' '), profile[counter]))
+        print(*stderr, sep='\n', file=sys.stderr)
+    if args.profile_phase and not profile['cprofile'].getstats():
+        # Like parsing with the cache warm, or listing changed files without `--changed-since`
+        print('\nThe `%s` phase never ran, nothing to profile' % args.profile_phase, file=sys.stderr)
+    elif args.profile_phase:
+        print('\ncProfile of the `%s` phase:' % args.profile_phase, file=sys.stderr)
+        Stats(profile['cprofile'], stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+
+
+#
+# Parse cache
+#
+#   Reduced facts of every parsed file are pickled to `--cache-dir` and keyed
+#   by their kind and the absolute path. Entry is reused while size and mtime
+#   are unchanged, or while content hash matches if they are not. Facts are
+#   also looked up by content hash alone, so identical files, like generated
+#   READMEs, are parsed once. Least recently used entries are evicted once
+#   there are more than CACHE_MAX_ENTRIES of them.
+#
+#   Unpickling runs arbitrary code, hence the cache defaults to a directory
+#   of the user rather than of the checkout, and is ignored unless the user
+#   owns it and no one else can write to it. Cache that fails to load, or
+#   entries of it that are malformed, are dropped and rebuilt. Every run
+#   writes its own temporary file, so concurrent ones never interleave.
+#
+#      +-----------+-------------------------------------------+
+#      | Facts     |                                           |
+#      |-----------+-------------------------------------------|
+#      | tasks     | number of tasks, ((task, named, module,   |
+#      |           |  become, become_user, parent, include),   |
+#      |           |  ...) of the tasks that matter only       |
+#      | vars      | (variable, type), ...                     |
+#      | defaults  | (variable, type), ...                     |
+#      | readme    | (variable, default), ...                  |
+#      | meta      | (dependency, become, become_user), ...    |
+#      | inventory | (variable, type), ...                     |
+#      | usage     | ((variable, line), ...), (declared, ...)  |
+#      | template  | ((variable, line), ...), ()               |
+#      +-----------+-------------------------------------------+
+#
+CACHE_VERSION = 8
+CACHE_MAX_ENTRIES = 20000
+CACHE_ENTRY_KEYS = frozenset(('type', 'size', 'mtime', 'hash', 'used', 'facts'))
+cache: dict = {'path': os.path.join(args.cache_dir, 'facts.pickle'), 'entries': {}, 'by_hash': {}, 'touched': set()}
+
+def cache_trusted(path):
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return False
+    return path_stat.st_uid == os.getuid() and not path_stat.st_mode & 0o022
+
+def cache_load():
+    if args.no_cache:
+        return
+    if not cache_trusted(args.cache_dir) or not cache_trusted(cache['path']):
+        return
+    profile['bytes_read'] += os.path.getsize(cache['path']) if os.path.isfile(cache['path']) else 0
+    try:
+        with open(cache['path'], 'rb') as cache_file:
+            cache_loaded = pickle.load(cache_file)
+        if not isinstance(cache_loaded, dict) or cache_loaded.get('version') != CACHE_VERSION:
+            return
+        cache_entries = {k: e for k, e in cache_loaded['entries'].items() if cache_entry_valid(k, e)}
+    except Exception:
+        # Truncated or otherwise corrupted, rebuilt on save
+        return
+    cache['entries'] = cache_entries
+    cache['by_hash'] = {(e['type'], e['hash']): e['facts'] for e in cache_entries.values()}
+
+def cache_entry_valid(key, entry):
+    return isinstance(key, tuple) and len(key) == 2 and isinstance(entry, dict) and \
+        CACHE_ENTRY_KEYS.issubset(entry) and entry['type'] == key[0] and isinstance(entry['hash'], str)
+
+def cache_save():
+    if args.no_cache:
+        return
+    if len(cache['entries']) > CACHE_MAX_ENTRIES:
+        cache_lru = sorted(cache['entries'], key=lambda k: cache['entries'][k]['used'])
+        for f in cache_lru[:len(cache_lru) - CACHE_MAX_ENTRIES]:
+            del cache['entries'][f]
+    try:
+        os.makedirs(args.cache_dir, mode=0o700, exist_ok=True)
+        # Created with 0600, unique to this run
+        cache_fd, cache_tmp = mkstemp(dir=args.cache_dir, prefix='.facts.', suffix='.tmp')
+        try:
+            with os.fdopen(cache_fd, 'wb') as cache_file:
+                pickle.dump({'version': CACHE_VERSION, 'entries': cache['entries']}, cache_file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_tmp, cache['path'])
+        except BaseException:
+            os.unlink(cache_tmp)
+            raise
+    except OSError as exc:
+        report_warning('WARNING: Unable to write the cache to %s: %s' % (args.cache_dir, exc))
+
+
+#
+# Load YAML, with libyaml if it is available
+#
+#   Values of the tags SafeLoader doesn't know, like the inline `!vault` of
+#   Ansible, are constructed as plain strings, lists and dictionaries. The
+#   top-level scan takes `!vault` and `!unsafe` scalars for strings as well,
+#   other tags are left to the complete load.
+#
+ANSIBLE_TAGS = ('!vault', '!unsafe')
+
+class AnsibleSafeLoader(SafeLoader):
+    def construct_undefined(self, node):
+        if isinstance(node, ScalarNode):
+            return self.construct_scalar(node)
+        if isinstance(node, SequenceNode):
+            return self.construct_sequence(node)
+        return self.construct_mapping(node)
+
+    yaml_constructors = {**SafeLoader.yaml_constructors, None: construct_undefined}
+
+def yaml_safe_load(stream):
+    return yaml_load(stream, Loader=AnsibleSafeLoader)
+
+
+#
+# Scan top-level keys and types of vars and defaults
+#
+#   Returns [(key, type), ...] of the top-level mapping, walking the events
+#   stream without constructing nested values. Returns None if the document
+#   is anything the scan can't mirror `yaml_safe_load` on: not a single
+#   mapping, explicit tags other than Ansible's, merge keys, complex keys or
+#   unknown anchors.
+#
+def yaml_top_level_types(content):
+    loader = SafeLoader(content)
+    try:
+        return yaml_scan_top_level(loader)
+    except YAMLError:
+        return None
+    finally:
+        loader.dispose()
+
+def yaml_scan_top_level(loader):
+    loader.get_event()
+    if not loader.check_event(DocumentStartEvent):
+        return None
+    loader.get_event()
+    root = loader.get_event()
+    if not isinstance(root, MappingStartEvent) or root.tag not in (None, '!'):
+        return None
+    anchors = {}
+    top_level = {}
+
+    def scalar(event):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(ScalarNode, event.value, event.implicit)
+        return loader.construct_object(ScalarNode(tag, event.value, event.start_mark, event.end_mark, event.style))
+
+    def value_type(event):
+        if isinstance(event, AliasEvent):
+            if event.anchor not in anchors:
+                return None
+            return anchors[event.anchor]
+        if event.tag in ANSIBLE_TAGS and isinstance(event, ScalarEvent):
+            v_type = str
+        elif event.tag not in (None, '!'):
+            return None
+        elif isinstance(event, ScalarEvent):
+            v_type = type(scalar(event))
+        else:
+            v_type = dict if isinstance(event, MappingStartEvent) else list
+            # Skip nested nodes, keeping their anchors
+            depth = 1
+            while depth:
+                nested = loader.get_event()
+                if isinstance(nested, CollectionStartEvent):
+                    depth += 1
+                elif not isinstance(nested, (ScalarEvent, AliasEvent)):
+                    depth -= 1
+                    continue
+                if isinstance(nested, AliasEvent):
+                    if nested.anchor not in anchors:
+                        return None
+                    continue
+                if nested.tag not in (None, '!'):
+                    return None
+                if isinstance(nested, ScalarEvent) and nested.anchor is not None:
+                    anchors[nested.anchor] = type(scalar(nested))
+                elif isinstance(nested, MappingStartEvent) and nested.anchor is not None:
+                    anchors[nested.anchor] = dict
+                elif isinstance(nested, SequenceStartEvent) and nested.anchor is not None:
+                    anchors[nested.anchor] = list
+        if event.anchor is not None:
+            anchors[event.anchor] = v_type
+        return v_type
+
+    while not loader.check_event(MappingEndEvent):
+        key_event = loader.get_event()
+        if not isinstance(key_event, ScalarEvent) or key_event.tag not in (None, '!'):
+            return None
+        if loader.resolve(ScalarNode, key_event.value, key_event.implicit) == 'tag:yaml.org,2002:merge':
+            return None
+        key = scalar(key_event)
+        v_type = value_type(loader.get_event())
+        if v_type is None:
+            return None
+        top_level[key] = v_type
+    loader.get_event()
+    loader.get_event()
+    # Multiple documents are an error for the complete load
+    if not loader.check_event(StreamEndEvent):
+        return None
+    return list(top_level.items())
+
+
+#
+# Extract variables from README.md tables
+#
+#   ...
+#   | Variable | Description | Default |
+#   |----------+-------------+---------|
+#   | foo      | `foo` var   | 42      |
+#   ...
+#
+#   Lines are streamed, a table starts with the header above and ends with the
+#   first line that isn't a table row. Any number of tables is allowed.
+#   Defaults which are obviously numbers, constants, quoted or bare strings are
+#   classified without `literal_eval`, the rest is evaluated and falls back to
+#   the raw string.
+#
+README_HEADER = re_compile(r'\|\s+Variable\s+\|\s+Description\s+\|\s+Default\s+\|')
+README_ROW = re_compile(r'^\|\s+(\w+)\s+\|\s+[^|]+\s+\|\s+([^|]+)\s+\|$')
+README_INT = re_compile(r'-?(0|[1-9][0-9]*)$')
+README_FLOAT = re_compile(r'-?[0-9]+\.[0-9]+$')
+README_BARE = re_compile(r'[A-Za-z_][\w.-]*$')
+README_CONSTANTS = {'True': True, 'False': False, 'None': None}
+
+def readme_value(value):
+    if value in README_CONSTANTS:
+        return README_CONSTANTS[value]
+    if README_INT.match(value):
+        return int(value)
+    if README_FLOAT.match(value):
+        return float(value)
+    if README_BARE.match(value):
+        return value
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '\'"' and \
+            value[0] not in value[1:-1] and '\\' not in value:
+        return value[1:-1]
+    try:
+        return literal_eval(value)
+    except Exception:
+        profile['literal_eval_fallbacks'] += 1
+        return value
+
+def readme_variables(lines):
+    in_table = False
+    for ln in lines:
+        if not in_table:
+            in_table = README_HEADER.match(ln) is not None
+        elif not ln.startswith('|'):
+            in_table = False
+        else:
+            row = README_ROW.match(ln)
+            if row:
+                yield row.group(1), readme_value(row.group(2).strip())
+
+
+#
+# Find variables used in Jinja expressions
+#
+#   `{{ ... }}` and `{% ... %}` are tokenised with a single regular expression
+#   pass. A name is a variable unless it is a keyword, an attribute, a filter
+#   or a test, a function or keyword argument, or is set by the template
+#   itself: `{% for %}`, `{% set %}`, `{% macro %}` and so on. Conditionals
+#   of tasks are expressions without the braces.
+#
+#   YAMLs are composed into nodes, which know their lines, without
+#   constructing values. Values of `register`, `loop_var` and keys of
+#   `set_fact` and `vars` are variables the role declares on its own.
+#   Quoted strings are skipped as a whole, `}}` or `%}` within them
+#   doesn't end the expression.
+#
+JINJA_BODY = r'''((?:'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|.)*?)'''
+JINJA_BLOCKS = re_compile(
+    r'{#.*?#}|{%-?\s*raw\s*-?%}.*?{%-?\s*endraw\s*-?%}|{{' + JINJA_BODY + '}}|{%' + JINJA_BODY + '%}', DOTALL
+)
+JINJA_TOKENS = re_compile(
+    r'''(?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|(?P<name>[A-Za-z_]\w*)|(?P<number>\d[\w.]*)|(?P<op>\S)'''
+)
+JINJA_KEYWORDS = frozenset((
+    'and', 'or', 'not', 'in', 'is', 'if', 'else', 'elif', 'endif', 'for', 'endfor', 'set', 'endset',
+    'block', 'endblock', 'macro', 'endmacro', 'call', 'endcall', 'filter', 'endfilter', 'with', 'endwith',
+    'include', 'import', 'from', 'as', 'extends', 'ignore', 'missing', 'context', 'without', 'recursive',
+    'autoescape', 'endautoescape', 'do', 'break', 'continue', 'true', 'false', 'none', 'True', 'False', 'None',
+    'loop', 'super', 'self', 'varargs', 'kwargs', 'caller',
+))
+JINJA_CONDITIONALS = ('when', 'changed_when', 'failed_when', 'until')
+JINJA_DECLARING = ('set_fact', 'ansible.builtin.set_fact', 'vars')
+# YAMLs without any of these have nothing to compose them for
+JINJA_RELEVANT = re_compile(rb'{{|{%|when|until|register|loop_var|set_fact|vars')
+
+JINJA_NAMING = ('macro', 'import', 'from', 'block', 'filter')
+
+def jinja_names(expression, statement, names, local):
+    tokens = [(m.lastgroup, m.group()) for m in JINJA_TOKENS.finditer(expression)]
+    head = tokens[0][1] if statement and tokens else None
+    loop_in = next((i for i, (_, token) in enumerate(tokens) if token == 'in'), 0) if head == 'for' else 0
+    for i, (kind, token) in enumerate(tokens):
+        if kind != 'name' or token in JINJA_KEYWORDS:
+            continue
+        # Set by the template itself
+        if head in JINJA_NAMING or i < loop_in or (head == 'set' and i == 1):
+            local.add(token)
+            continue
+        previous = tokens[i - 1][1] if i > 0 else None
+        following = tokens[i + 1][1] if i + 1 < len(tokens) else None
+        if previous in ('.', '|', 'is') or following == '(':
+            continue
+        if previous == 'not' and i > 1 and tokens[i - 2][1] == 'is':
+            continue
+        # Keyword argument, or a name set by `{% with %}`
+        if following == '=' and (i + 2 == len(tokens) or tokens[i + 2][1] != '='):
+            if head == 'with':
+                local.add(token)
+            continue
+        names.append(token)
+
+def jinja_usages(text, line, usages, local, conditional=False):
+    if conditional and '{{' not in text and '{%' not in text:
+        names = []
+        jinja_names(text, False, names, local)
+        usages.extend((name, line) for name in names)
+        return
+    position = 0
+    for block in JINJA_BLOCKS.finditer(text):
+        expression, statement = block.group(1), block.group(2)
+        if expression is None and statement is None:
+            continue
+        line += text.count('\n', position, block.start())
+        position = block.start()
+        names = []
+        jinja_names((statement if expression is None else expression).strip('-+ \t\r\n'), expression is None,
+                    names, local)
+        usages.extend((name, line) for name in names)
+
+def yaml_usages(node, key, usages, declared, local):
+    if isinstance(node, ScalarNode):
+        if node.tag == 'tag:yaml.org,2002:str':
+            # Block scalars start on the line after their indicator
+            line = node.start_mark.line + (2 if node.style in ('|', '>') else 1)
+            jinja_usages(node.value, line, usages, local, key in JINJA_CONDITIONALS)
+    elif isinstance(node, SequenceNode):
+        for item in node.value:
+            yaml_usages(item, key, usages, declared, local)
+    elif isinstance(node, MappingNode):
+        for key_node, value_node in node.value:
+            node_key = key_node.value if isinstance(key_node, ScalarNode) else None
+            if key in JINJA_DECLARING and node_key not in (None, 'cacheable'):
+                declared.add(node_key)
+            if node_key in ('register', 'loop_var') and isinstance(value_node, ScalarNode):
+                declared.add(value_node.value)
+                continue
+            yaml_usages(value_node, node_key, usages, declared, local)
+
+def usage_facts(content, f_type):
+    usages, declared, local = [], set(), set()
+    if f_type == 'template':
+        jinja_usages(content.decode('utf-8', errors='replace'), 1, usages, local)
+    elif JINJA_RELEVANT.search(content):
+        for document in yaml_compose_all(content, Loader=SafeLoader):
+            yaml_usages(document, None, usages, declared, local)
+    return tuple(dict.fromkeys(usage for usage in usages if usage[0] not in local)), tuple(sorted(declared))
+
+
+#
+# Extract facts from the file content
+#
+#   Tasks are numbered in order, tasks of blocks, rescues and always follow
+#   the block they belong to. Each task is reduced as soon as it is reached
+#   and only the ones that could be reported or affect others are kept:
+#   nameless, setting `become` or `become_user` and including other files.
+#   Parent is the number of the closest enclosing block setting `become` or
+#   `become_user`, blocks which don't are of no interest to their tasks.
+#
+TASK_INCLUDES = ('include_tasks', 'import_tasks', 'include',
+                 'ansible.builtin.include_tasks', 'ansible.builtin.import_tasks', 'ansible.builtin.include')
+TASK_BLOCKS = ('block', 'rescue', 'always')
+
+def tasks_walk(tasks, numbers, parent):
+    for task in tasks:
+        if not isinstance(task, dict):
+            continue
+        task_number = next(numbers)
+        yield task_number, task, parent
+        block_parent = parent
+        if task.get('become') is not None or task.get('become_user') is not None:
+            block_parent = task_number
+        for block in TASK_BLOCKS:
+            if isinstance(task.get(block), list):
+                yield from tasks_walk(task[block], numbers, block_parent)
+
+def task_facts(task_number, task, parent):
+    task_include = next((task[k] for k in TASK_INCLUDES if k in task), None)
+    if isinstance(task_include, dict):
+        task_include = task_include.get('file')
+    if not isinstance(task_include, str):
+        task_include = None
+    named = bool(task.get('name'))
+    become, become_user = task.get('become'), task.get('become_user')
+    if named and become is None and become_user is None and task_include is None:
+        return None
+    # Module is the first key after the name, assuming that goes first
+    task_keys = list(islice(task, 2))
+    task_module = task_keys[int(named)] if len(task_keys) > int(named) else None
+    return task_number, named, task_module, become, become_user, parent, task_include
+
+def tasks_facts(tasks):
+    numbers = count(1)
+    facts = tuple(filter(None, (task_facts(*task) for task in tasks_walk(tasks, numbers, None))))
+    return next(numbers) - 1, facts
+
+def meta_facts(meta):
+    dependencies = []
+    for dependency in (meta.get('dependencies') or []) if isinstance(meta, dict) else []:
+        if isinstance(dependency, dict):
+            dependency_role = dependency.get('role') or dependency.get('name')
+            if isinstance(dependency_role, str):
+                dependencies.append((dependency_role, dependency.get('become'), dependency.get('become_user')))
+        elif isinstance(dependency, str):
+            dependencies.append((dependency, None, None))
+    return dependencies
+
+def parse_facts(content, f_type):
+    if f_type in ('usage', 'template'):
+        return usage_facts(content, f_type)
+    if f_type == 'readme':
+        # Universal newlines, as of a file opened in text mode, rows of CRLF READMEs end with `|` too
+        return list(readme_variables(StringIO(content.decode('utf-8'), newline=None)))
+    # Encrypted as a whole, variables of it are unknown until it is decrypted
+    if f_type in ('vars', 'defaults', 'inventory') and content.lstrip().startswith(b'$ANSIBLE_VAULT;'):
+        return []
+    if f_type in ('vars', 'defaults', 'inventory') and args.loader == 'fast':
+        var_facts = yaml_top_level_types(content)
+        if var_facts is not None:
+            return var_facts
+    f_yaml_loaded = yaml_safe_load(content)
+    if f_type == 'meta':
+        return meta_facts(f_yaml_loaded)
+    try:
+        if f_type == 'tasks':
+            return tasks_facts(f_yaml_loaded) if isinstance(f_yaml_loaded, list) else None
+        return [(var, type(f_yaml_loaded[var])) for var in f_yaml_loaded]
+    except TypeError:
+        # Nothing to iterate over, file is empty or is a scalar
+        return None
+
+def file_facts(f, f_type):
+    f_key = os.path.abspath(f)
+    f_entry = scanned_entries.get(f_key)
+    f_stat = f_entry.stat() if f_entry else os.stat(f_key)
+    entry = cache['entries'].get((f_type, f_key))
+    cache['touched'].add((f_type, f_key))
+    if entry and entry['size'] == f_stat.st_size and entry['mtime'] == f_stat.st_mtime_ns:
+        entry['used'] = time()
+        profile['cache_hits'] += 1
+        return entry['facts']
+    with open(f_key, 'rb') as f_bytes:
+        content = f_bytes.read()
+    profile['bytes_read'] += len(content)
+    content_hash = sha1(content).hexdigest()
+    if (f_type, content_hash) in cache['by_hash']:
+        profile['cache_hits'] += 1
+        facts = cache['by_hash'][(f_type, content_hash)]
+    else:
+        with phase('parse-' + f_type):
+            parse_started = perf_counter()
+            facts = parse_facts(content, f_type)
+            profile['files'][f_key] = perf_counter() - parse_started
+        cache['by_hash'][(f_type, content_hash)] = facts
+    cache['entries'][(f_type, f_key)] = {
+        'type': f_type,
+        'size': f_stat.st_size,
+        'mtime': f_stat.st_mtime_ns,
+        'hash': content_hash,
+        'used': time(),
+        'facts': facts
+    }
+    return facts
+
+def invalid_yaml(f):
+    return 'WARNING: ..' + f.split('roles')[1] + ' has no valid YAML content'
+
+
+with phase('cache'):
+    cache_load()
+
+
 #
 # Open playbook, parse its content
 #
-with open(args.playbook, 'r') as pbook_yaml:
+def load_playbook(pbook):
+    with open(pbook, 'rb') as pbook_yaml:
+        pbook_content = pbook_yaml.read()
+    profile['bytes_read'] += len(pbook_content)
     try:
-        pbook_yaml_parsed = yaml_safe_load(pbook_yaml)
-    except ScannerError as exc:
-        badroles(exc.args)
-    pbook_name = os.path.basename(args.playbook)
-    pbook_roles_added = []
+        pbook_yaml_parsed = yaml_safe_load(pbook_content)
+    except YAMLError as exc:
+        badroles(pbook, exc)
+        return None
+    pbook_name = os.path.basename(pbook)
+    # Directories of playbooks may have other YAMLs in them, like `requirements.yml`
+    if pbook_yaml_parsed is not None and not isinstance(pbook_yaml_parsed, list):
+        report_warning('WARNING: %s is not a list of plays, skipped' % pbook_name)
+        return None
+    pbook_plays = []
+    for play_num, play in enumerate(pbook_yaml_parsed or []):
+        if isinstance(play, dict):
+            pbook_plays.append(play)
+        else:
+            report_warning('WARNING: Play #%s in %s is not a mapping, skipped' % (play_num, pbook_name))
+    pbook_roles = {}
+    pbook_task_nums = count()
     #
     #   REQUIREMENTS
     #
     #  - There is at least one (import|include)_role statement per Playbook task
     #  - No importing and including is happening in the same task simultaneously
-    #  - No role is imported or included twice
+    #  - No role is imported or included twice within a play. Role of several
+    #    plays, like ones for different hosts, is checked against the vars of
+    #    all of them, later ones overriding the earlier.
     #
-    for pbook_task_num, pbook_task in enumerate(pbook_yaml_parsed[0]['tasks']):
-        if 'import_role' in pbook_task and 'include_role' in pbook_task:
-                # Using task number in case it doesn't have a name
-                print('Task #%s in %s has both `import_role` and `include_role`.'
-                      % (pbook_task_num, pbook_name)
-                )
-        elif 'import_role' not in pbook_task and 'include_role' not in pbook_task:
-                print('Task #%s in %s has neither `import_role` nor `include_role`.'
-                      % (pbook_task_num, pbook_name),
-                )
-        # import_role
-        elif 'import_role' in pbook_task:
-            collected['playbook'][pbook_task['import_role']['name']] = pbook_task['vars']
-            pbook_roles_added.append(pbook_task['import_role']['name'])
-        # include_role
-        elif 'include_role' in pbook_task:
-            collected['playbook'][pbook_task['include_role']['name']] = pbook_task['vars']
-            pbook_roles_added.append(pbook_task['include_role']['name'])
-    pbook_yaml.close()
-
-
-#
-# Check for duplicates
-#
-if len(set(pbook_roles_added)) != len(pbook_roles_added):
-    # We don't know which one is correct, hence the safe exit
-    print('%s contains duplicated roles. Aborting.' % pbook_name)
-    os._exit(os.EX_DATAERR)
+    for play in pbook_plays:
+        play_roles_added = []
+        for pbook_task, pbook_task_num in zip(play.get('tasks') or [], pbook_task_nums):
+            if not isinstance(pbook_task, dict):
+                report_warning('WARNING: Task #%s in %s is not a mapping, skipped' % (pbook_task_num, pbook_name))
+            elif 'import_role' in pbook_task and 'include_role' in pbook_task:
+                    # Using task number in case it doesn't have a name
+                    report_warning('Task #%s in %s has both `import_role` and `include_role`.'
+                                   % (pbook_task_num, pbook_name))
+            elif 'import_role' not in pbook_task and 'include_role' not in pbook_task:
+                    report_warning('Task #%s in %s has neither `import_role` nor `include_role`.'
+                                   % (pbook_task_num, pbook_name))
+            # import_role
+            elif 'import_role' in pbook_task:
+                play_roles_added.append((pbook_task['import_role']['name'], pbook_task.get('vars') or {}))
+            # include_role
+            elif 'include_role' in pbook_task:
+                play_roles_added.append((pbook_task['include_role']['name'], pbook_task.get('vars') or {}))
+        #
+        # Check for duplicates
+        #
+        if len(set(role for role, _ in play_roles_added)) != len(play_roles_added):
+            # We don't know which one is correct, hence the safe exit, or skip of the playbook if there are others
+            report_warning('%s contains duplicated roles. %s' % (pbook_name,
+                                                                 'Aborting.' if len(pbooks) == 1 else 'Skipped.'))
+            if len(pbooks) == 1:
+                os._exit(os.EX_DATAERR)
+            return None
+        for role, role_vars in play_roles_added:
+            pbook_roles[role] = {**pbook_roles.get(role, {}), **role_vars}
+    return pbook_roles
+
+def role_path(pbook, role):
+    return os.path.join(os.path.dirname(os.path.abspath(pbook)), 'roles', role)
+
+
+#
+# Collect files: tasks, vars, defaults, meta and README.md
+#
+#   Only the role layout is scanned, `files/` and everything else is never
+#   descended into, `handlers/` and `templates/` are only with `-u`. YAMLs in
+#   subdirectories, like `vars/main/*.yml`, are collected up to `--scan-depth`
+#   levels down. Directory entries are kept for the cache to reuse their stat
+#   instead of looking files up again.
+#
+ROLE_LAYOUT = ('tasks', 'vars', 'defaults', 'meta')
+# Next to the playbooks
+INVENTORY_DIRS = ('group_vars', 'host_vars')
+INVENTORY_EXTENSIONS = ('.yml', '.yaml', '.json')
+scanned_entries: dict = {}
 
+def scan_dir(path, depth, found, scanned, suffixes=('.yml', '.yaml')):
+    scanned['dirs'].append(path)
+    try:
+        with os.scandir(path) as dir_entries:
+            for entry in sorted(dir_entries, key=lambda e: e.name):
+                scanned['entries'] += 1
+                if entry.name.endswith(suffixes) and entry.is_file():
+                    found.append(entry.path)
+                    scanned_entries[entry.path] = entry
+                elif depth > 0 and entry.is_dir():
+                    scan_dir(entry.path, depth - 1, found, scanned, suffixes)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
 
+def collect_files(role_path):
+    role_files = {'tasks': [], 'readme': [], 'vars': [], 'defaults': [], 'meta': [], 'handlers': [], 'templates': []}
+    scanned = {'entries': 0, 'dirs': [role_path]}
+    try:
+        with os.scandir(role_path) as dir_entries:
+            role_entries = {entry.name: entry for entry in dir_entries}
+    except (FileNotFoundError, NotADirectoryError):
+        role_entries = {}
+    scanned['entries'] += len(role_entries)
+    if 'README.md' in role_entries and role_entries['README.md'].is_file():
+        role_files['readme'].append(role_entries['README.md'].path)
+    for layout_dir in ROLE_LAYOUT:
+        if layout_dir in role_entries and role_entries[layout_dir].is_dir():
+            scan_dir(role_entries[layout_dir].path, args.scan_depth, role_files[layout_dir], scanned)
+    if args.usage:
+        if 'handlers' in role_entries and role_entries['handlers'].is_dir():
+            scan_dir(role_entries['handlers'].path, args.scan_depth, role_files['handlers'], scanned)
+        # Templates mirror paths they are deployed to, hence any depth
+        if 'templates' in role_entries and role_entries['templates'].is_dir():
+            scan_dir(role_entries['templates'].path, sys.maxsize, role_files['templates'], scanned, ('.j2',))
+    profile['dir_entries'] += scanned['entries']
+    return role_files, scanned
+
+
+#
+# Walk the task graph: task files, blocks, includes and role dependencies
 #
-# Collect files: tasks, vars, defaults and README.md
-#
-if len(collected['playbook']) > 0:
-    for role in collected['playbook']:
-        collected['files'][role] = { 'tasks': [], 'readme': [], 'vars': [], 'defaults': [] }
-        role_path = os.path.join(os.path.dirname(os.path.normpath(args.playbook)), 'roles', role)
-        role_readme = os.path.join(role_path, 'README.md')
-        if os.path.isfile(role_readme):
-            collected['files'][role]['readme'].append(role_readme)
-        for root, dirs, files in os.walk(role_path):
-            root_base = os.path.basename(os.path.normpath(root))
-            if root_base  == 'vars':
-                for f in files:
-                    if f.endswith('.yaml') or f.endswith('.yml'):
-                        collected['files'][role]['vars'].append(os.path.join(root, f))
-            if root_base  == 'defaults':
-                for f in files:
-                    if f.endswith('.yaml') or f.endswith('.yml'):
-                        collected['files'][role]['defaults'].append(os.path.join(root, f))
-            if root_base == 'tasks':
-                for f in files:
-                    if f.endswith('.yaml') or f.endswith('.yml'):
-                        collected['files'][role]['tasks'].append(os.path.join(root, f))
-else:
-    noroles()
-
-
-#
-# Collect tasks data: name, module, become and become_user
-#
-if args.become:
-    for role in collected['files']:
-        collected['roles'][role] = {'tasks': {}}
-        for f in collected['files'][role]['tasks']:
-            fname = os.path.basename(f)
-            collected['roles'][role]['tasks'][fname] = {1: {}}
-            try:
-                with open(f, 'r') as f_yaml:
-                    f_yaml_loaded = yaml_safe_load(f_yaml)
-                    task_number = 0
-                    for task in f_yaml_loaded:
-                        task_number += 1
-                        collected['roles'][role]['tasks'][fname][task_number] = {
-                            'name': None,
-                            'module': None,
-                            'become': None,
-                            'become_user': None
-                        }
-                        for k in ['name', 'become', 'become_user']:
-                            if k in task:
-                                collected['roles'][role]['tasks'][fname][task_number][k] = task.get(k, None)
-                        task_enum = list(enumerate(task))
-                        if not collected['roles'][role]['tasks'][fname][task_number]['name']:
-                            collected['roles'][role]['tasks'][fname][task_number]['module'] = task_enum[0][1]
-                        else:
-                            if len(task_enum) > 1:
-                                collected['roles'][role]['tasks'][fname][task_number]['module'] = task_enum[1][1]
-            except TypeError:
-                print('WARNING: ..' + f.split('roles')[1] + ' has no valid YAML content')
+#   Tasks inherit `become` and `become_user` of the blocks, include and import
+#   tasks and the dependency declarations above them, hence every task file
+#   is checked in the context of the path leading to it. Walk starts with
+#   `tasks/main.yml`, then goes over files nothing has included. Dependency
+#   roles, unless the playbook references them on their own, are walked from
+#   their `tasks/main.yml` as well.
+#
+#   Findings are memoised per file or dependency role and the inherited
+#   context, so each of them is parsed and checked once per distinct context,
+#   however many paths lead to it. Files are the role's own, hence forgotten
+#   once the role is checked. Dependency roles are remembered for the whole
+#   run, along with their warnings and paths to watch, which are replayed for
+#   every role depending on them: what the role gets doesn't depend on which
+#   of the workers checked the dependency first. Include and dependency
+#   cycles are reported and cut off.
+#
+#   Findings: (issue, tasks file, task number, tasks in the file, module)
+#   Roles:    {(dependency role, context): (findings, warnings, paths)}
+#
+task_graph: dict = {'files': {}, 'roles': {}, 'walked': set()}
+
+def include_path(f, role_dir, include):
+    if '{{' in include or '{%' in include:
+        return None
+    for include_dir in (os.path.dirname(f), os.path.join(role_dir, 'tasks')):
+        include_f = os.path.normpath(os.path.join(include_dir, include))
+        if os.path.isfile(include_f):
+            return include_f
+    return None
+
+def walk_tasks(f, role_dir, context, role_warnings, visiting):
+    if (f, context) in task_graph['files']:
+        return task_graph['files'][(f, context)]
+    if f in visiting:
+        role_warnings.append('WARNING: ..%s includes itself, include cycle is skipped' % f.split('roles')[1])
+        return []
+    task_graph['walked'].add(f)
+    f_tasks = file_facts(f, 'tasks')
+    if f_tasks is None:
+        role_warnings.append(invalid_yaml(f))
+        task_graph['files'][(f, context)] = []
+        return []
+    visiting.append(f)
+    findings = []
+    inherited = {}
+    tasks_total, f_tasks = f_tasks
+    for task_number, named, module, become, become_user, parent, include in f_tasks:
+        parent_become, parent_become_user = inherited[parent] if parent is not None else context
+        task_become = parent_become if become is None else become
+        task_become_user = parent_become_user if become_user is None else become_user
+        inherited[task_number] = (task_become, task_become_user)
+        # Nonames
+        if not named:
+            findings.append(('tasks_without_names', f, task_number, tasks_total, module))
+        # Inherited values are checked where they are set
+        if become is not None or become_user is not None:
+            # Become-no-user
+            if task_become not in [None, False] and not isinstance(task_become_user, str):
+                findings.append(('become_without_become-user', f, task_number, tasks_total, module))
+            # Become-no-become (or `become` is False)
+            if task_become_user is not None and not isinstance(task_become, bool) or task_become is False:
+                findings.append(('become-user_without_become', f, task_number, tasks_total, module))
+        include_f = include_path(f, role_dir, include) if include else None
+        if include_f:
+            findings.extend(walk_tasks(include_f, role_dir, (task_become, task_become_user), role_warnings, visiting))
+    visiting.pop()
+    task_graph['files'][(f, context)] = findings
+    return findings
+
+def walk_dependencies(role_dir, role_files, context, role_warnings, role_paths, visiting):
+    findings = []
+    for f in role_files['meta']:
+        if os.path.dirname(f) != os.path.join(role_dir, 'meta') or os.path.basename(f) not in ('main.yml', 'main.yaml'):
+            continue
+        dependencies = file_facts(f, 'meta')
+        if dependencies is None:
+            role_warnings.append(invalid_yaml(f))
+            continue
+        for dependency, become, become_user in dependencies:
+            dependency_dir = os.path.join(os.path.dirname(role_dir), dependency)
+            if dependency_dir in roles_referenced or not os.path.isdir(dependency_dir):
+                continue
+            dependency_context = (context[0] if become is None else become,
+                                  context[1] if become_user is None else become_user)
+            findings.extend(walk_role(dependency_dir, dependency_context, role_warnings, role_paths, visiting))
+    return findings
+
+def walk_role(role_dir, context, role_warnings, role_paths, visiting):
+    if (role_dir, context) not in task_graph['roles']:
+        if role_dir in visiting:
+            role_warnings.append('WARNING: Role %s depends on itself, dependency cycle is skipped'
+                                 % os.path.basename(role_dir))
+            return []
+        visiting.append(role_dir)
+        warnings = []
+        role_files, scanned = collect_files(role_dir)
+        paths = list(chain(scanned['dirs'], role_files['tasks'], role_files['meta']))
+        findings = walk_dependencies(role_dir, role_files, context, warnings, paths, visiting)
+        for f in role_files['tasks']:
+            if os.path.dirname(f) == os.path.join(role_dir, 'tasks') and \
+                    os.path.basename(f) in ('main.yml', 'main.yaml'):
+                findings.extend(walk_tasks(f, role_dir, context, warnings, []))
+        visiting.pop()
+        task_graph['roles'][(role_dir, context)] = findings, warnings, paths
+    findings, warnings, paths = task_graph['roles'][(role_dir, context)]
+    role_warnings.extend(warnings)
+    role_paths.extend(paths)
+    return findings
+
+def collect_tasks(role_dir, role_files, role_warnings, role_paths):
+    task_graph['files'].clear()
+    task_graph['walked'].clear()
+    findings = walk_dependencies(role_dir, role_files, (None, None), role_warnings, role_paths, [role_dir])
+    tasks_main = [f for f in role_files['tasks'] if os.path.dirname(f) == os.path.join(role_dir, 'tasks')
+                  and os.path.basename(f) in ('main.yml', 'main.yaml')]
+    for f in tasks_main:
+        findings.extend(walk_tasks(f, role_dir, (None, None), role_warnings, []))
+    for f in role_files['tasks']:
+        if f not in task_graph['walked']:
+            findings.extend(walk_tasks(f, role_dir, (None, None), role_warnings, []))
+    # Same task reached through several paths is reported once
+    files_order = {f: f_number for f_number, f in enumerate(role_files['tasks'])}
+    return sorted(
+        dict.fromkeys(findings),
+        key=lambda finding: (files_order.get(finding[1], len(files_order)), finding[1], finding[2])
+    )
 
 
 #
 # Collect variables from default/vars and README.md
 #
-if args.consistency:
-    for role in collected['files']:
-        collected['roles'][role]['variables'] = {'vars': [], 'defaults': [], 'readme': []}
-        var_def_rmd_files = [
-            collected['files'][role]['vars'],
-            collected['files'][role]['defaults'],
-            collected['files'][role]['readme']
-        ]
-        for f in list(chain(*var_def_rmd_files)):
-            if os.path.basename(os.path.abspath(os.path.join(f, os.pardir))) == 'vars':
-                f_type = 'vars'
-            elif os.path.basename(os.path.abspath(os.path.join(f, os.pardir))) == 'defaults':
-                f_type = 'defaults'
-            elif os.path.basename(f) == 'README.md':
-                f_type = 'readme'
-            else:
-                raise Exception('ERROR: Unexpected element in the %s role' % collected['files'][role])
-            if f_type != 'readme':
-                with open(f, 'r') as f_yaml:
-                    try:
-                        f_yaml_loaded = yaml_safe_load(f_yaml)
-                        for var in f_yaml_loaded:
-                            collected['roles'][role]['variables'][f_type].append([var, type(f_yaml_loaded[var])])
-                    except TypeError:
-                        print('WARNING: ..' + f.split('roles')[1] + ' has no valid YAML content')
-                f_yaml.close()
-            else:
-                with open(f, 'r') as f_readme:
-                    f_lines = f_readme.readlines()
-                    for ln in f_lines:
-                        # ...
-                        # | Variable | Description | Default |
-                        # |----------+-------------+---------|
-                        # | foo      | `foo` var   | 42      |
-                        # ...
-                        if match("^\|\s+\w+\s+\|\s+[^|]+\s+\|\s+[^|]+\s+\|$", ln):
-                            if not match("\|\s+Variable\s+\|\s+Description\s+\|\s+Default\s+\|", ln):
-                                readme_var = ln.split('|')[1].strip()
-                                readme_value = ln.split('|')[3].strip()
-                                try:
-                                    readme_value = literal_eval(readme_value)
-                                except (SyntaxError, BaseException):
-                                    readme_value = literal_eval(repr(readme_value))
-                                collected['roles'][role]['variables']['readme'].append([readme_var, readme_value])
-                f_readme.close()
+#   Indexed per role as {vars|defaults|readme: {variable: RoleVariable}}, in
+#   order of declaration. First declaration wins if a variable is repeated.
+#
+class RoleVariable:
+    __slots__ = ('name', 'kind', 'file', 'type', 'default')
+
+    def __init__(self, name, kind, file, var_type, default=None):
+        self.name = name
+        self.kind = kind
+        self.file = file
+        self.type = var_type
+        self.default = default
+
+def collect_variables(role_files, role_warnings):
+    role_variables = {'vars': {}, 'defaults': {}, 'readme': {}}
+    for f_type, f_index in role_variables.items():
+        for f in role_files[f_type]:
+            var_facts = file_facts(f, f_type)
+            if var_facts is None:
+                role_warnings.append(invalid_yaml(f))
+                continue
+            for var, value in var_facts:
+                if var not in f_index:
+                    if f_type == 'readme':
+                        f_index[var] = RoleVariable(var, f_type, f, type(value), value)
+                    else:
+                        f_index[var] = RoleVariable(var, f_type, f, value)
+    return role_variables
+
+
+#
+# Index variables the role uses
+#
+#   Inverted per role as {variable: [(file, line), ...]}, in order of the first
+#   use, over tasks, handlers, vars, defaults and templates. Variables which
+#   tasks declare on their own are collected alongside.
+#
+ANSIBLE_VARIABLES = frozenset((
+    'item', 'hostvars', 'groups', 'group_names', 'inventory_hostname', 'inventory_hostname_short', 'inventory_dir',
+    'inventory_file', 'play_hosts', 'playbook_dir', 'role_path', 'role_name', 'role_names', 'omit', 'environment',
+    'vars',
+))
+
+def collect_usages(role_files):
+    role_usages = {}
+    role_declared = set()
+    for f in chain(*(role_files[f_type] for f_type in ('tasks', 'handlers', 'vars', 'defaults', 'templates'))):
+        usages, declared = file_facts(f, 'template' if f.endswith('.j2') else 'usage')
+        for var, line in usages:
+            role_usages.setdefault(var, []).append((f, line))
+        role_declared.update(declared)
+    return role_usages, role_declared
 
 
 #
 # Find issues
 #
-for role in collected['playbook']:
-    collected['issues'][role] = {
+#   Every issue knows the file it was found in and, for the tasks, number of
+#   the task in that file or the line of the usage, so it could be reported
+#   in machine-readable formats.
+#
+class Issue:
+    __slots__ = ('kind', 'name', 'file', 'role', 'task', 'tasks', 'line')
+
+    def __init__(self, kind, name, file, role, task=None, tasks=None, line=None):
+        self.kind = kind
+        self.name = name
+        self.file = file
+        self.role = role
+        self.task = task
+        self.tasks = tasks
+        self.line = line
+
+    def __str__(self):
+        if self.line is not None:
+            return '%s from %s:%s' % (self.name, os.path.relpath(self.file, self.role), self.line)
+        if self.task is None:
+            return str(self.name)
+        return '(%s/%s) "%s" from %s' % (
+            self.task, self.tasks, self.name, os.path.relpath(self.file, os.path.join(self.role, 'tasks'))
+        )
+
+def find_issues(pbook, pbook_vars, role_dir, role_data):
+    role_issues = {
         'overwrites_defaults': [],         # Declared in playbook and overwriting defaults
         'in-playbook_not-in-role': [],     # Declared in playbook, but undeclared in the role
         'in-role_not-in-playbook': [],     # Declared in role, but absent in playbook
@@ -250,146 +1095,528 @@ for role in collected['playbook']:
         'type_mismatch': [],               # Type mismatch between the playbook and role
         'become_without_become-user': [],  # `become` without `become_user`
         'become-user_without_become': [],  # `become_user` without `become`
-        'tasks_without_names': []          # Tasks without `- name:`
+        'tasks_without_names': [],         # Tasks without `- name:`
+        'declared-but-unused': [],         # Declared in role, but never used
+        'used-but-undeclared': [],         # Used in role, but undeclared
     }
+    role_vars = role_data['variables']['vars']
+    role_defaults = role_data['variables']['defaults']
+    role_readme = role_data['variables']['readme']
+    # Set in the inventory next to the playbook counts as declared in it
+    pbook_inventory = collected['inventory'].get(os.path.dirname(os.path.abspath(pbook)), {})
     if args.consistency:
-        # variables declared in ../vars/*.yml
-        role_var_names = [v[0] for v in collected['roles'][role]['variables']['vars']]
-        for var in [var for var in collected['playbook'][role]]:
+        for var in pbook_vars:
             # Declared in playbook, but undeclared in the role
-            if var not in role_var_names and var not in collected['roles'][role]['variables']['defaults']:
-                collected['issues'][role]['in-playbook_not-in-role'].append(var)
+            if var not in role_vars and var not in role_defaults:
+                role_issues['in-playbook_not-in-role'].append(Issue('in-playbook_not-in-role', var, pbook, role_dir))
             # Declared in playbook and overwriting defaults
-            if var in collected['roles'][role]['variables']['defaults']:
-                collected['issues'][role]['overwrites_defaults'].append(var)
+            if var in role_defaults:
+                role_issues['overwrites_defaults'].append(Issue('overwrites_defaults', var, pbook, role_dir))
             # Type mismatch between the playbook and role
-            for cvar in collected['roles'][role]['variables']['vars']:
-                if cvar[0] == var:
-                    if type(collected['playbook'][role][var]) != cvar[1]:
-                        collected['issues'][role]['type_mismatch'].append(cvar[0])
-        for var in role_var_names:
-            # Declared in role, but absent in playbook
-            if var not in collected['playbook'][role]:
-                collected['issues'][role]['in-role_not-in-playbook'].append(var)
-            # Declared in role, but absent in Readme
-            if var not in [v[0] for v in collected['roles'][role]['variables']['readme']]:
-                collected['issues'][role]['in-role_not-in-readme'].append(var)
-        for var in [v[0] for v in collected['roles'][role]['variables']['readme']]:
-            # Declared in Readme, but absent in role
-            if var not in role_var_names:
-                collected['issues'][role]['in-readme_not-in-role'].append(var)
-            # Declared in Readme, but absent in playbook
-            if var not in [v for v in collected['playbook'][role]]:
-                collected['issues'][role]['in-readme_not-in-playbook'].append(var)
+            if var in role_vars and type(pbook_vars[var]) != role_vars[var].type:
+                role_issues['type_mismatch'].append(Issue('type_mismatch', var, pbook, role_dir))
+        # Declared in role, but absent in playbook
+        role_issues['in-role_not-in-playbook'] = [
+            Issue('in-role_not-in-playbook', var, role_vars[var].file, role_dir)
+            for var in role_vars if var not in pbook_vars and var not in pbook_inventory
+        ]
+        # Declared in role, but absent in Readme
+        role_issues['in-role_not-in-readme'] = [
+            Issue('in-role_not-in-readme', var, role_vars[var].file, role_dir)
+            for var in role_vars if var not in role_readme
+        ]
+        # Declared in Readme, but absent in role
+        role_issues['in-readme_not-in-role'] = [
+            Issue('in-readme_not-in-role', var, role_readme[var].file, role_dir)
+            for var in role_readme if var not in role_vars and var not in role_defaults
+        ]
+        # Declared in Readme, but absent in playbook
+        role_issues['in-readme_not-in-playbook'] = [
+            Issue('in-readme_not-in-playbook', var, role_readme[var].file, role_dir)
+            for var in role_readme if var not in pbook_vars and var not in pbook_inventory
+        ]
     if args.become:
-        for f in collected['roles'][role]['tasks']:
-            for task_number in collected['roles'][role]['tasks'][f]:
-                # Nonames
-                if not collected['roles'][role]['tasks'][f][task_number]['name']:
-                    collected['issues'][role]['tasks_without_names'].append(
-                        '(%s/%s) "%s" from %s' % (
-                            task_number,
-                            len(collected['roles'][role]['tasks'][f]),
-                            collected['roles'][role]['tasks'][f][task_number]['module'], f,
-                        )
-                    )
-                # Become-no-user
-                if collected['roles'][role]['tasks'][f][task_number]['become'] not in [None, False] and \
-                        not isinstance(collected['roles'][role]['tasks'][f][task_number]['become_user'], str):
-                            collected['issues'][role]['become_without_become-user'].append(
-                                '(%s/%s) "%s" from %s' % (
-                                    task_number, len(collected['roles'][role]['tasks'][f]),
-                                    collected['roles'][role]['tasks'][f][task_number]['module'], f,
-                                )
-                            )
-                # Become-no-become (or `become` is False)
-                if collected['roles'][role]['tasks'][f][task_number]['become_user'] is not None and \
-                        not isinstance(collected['roles'][role]['tasks'][f][task_number]['become'], bool) or \
-                        collected['roles'][role]['tasks'][f][task_number]['become'] is False:
-                            collected['issues'][role]['become-user_without_become'].append(
-                                '(%s/%s) "%s" from %s' % (
-                                    task_number, len(collected['roles'][role]['tasks'][f]),
-                                    collected['roles'][role]['tasks'][f][task_number]['module'], f,
-                                )
-                            )
-
-
-#
-# Count number of issues...
-#
-issues_count = len(
-    list(
-        chain.from_iterable(
-            list(
-                chain.from_iterable(
-                    [list(collected['issues'][issue].values()) for issue in collected['issues']]
-                )
-            )
-        )
-    )
-)
+        for issue, tasks_file, task_number, tasks_total, module in role_data['tasks']:
+            role_issues[issue].append(Issue(issue, module, tasks_file, role_dir, task_number, tasks_total))
+    if args.usage:
+        role_usages, role_declared = role_data['usages']
+        # Declared in role, but never used
+        for var, role_var in chain(role_vars.items(), role_defaults.items()):
+            if var not in role_usages and (role_var.kind == 'vars' or var not in role_vars):
+                role_issues['declared-but-unused'].append(Issue('declared-but-unused', var, role_var.file, role_dir))
+        # Used in role, but undeclared
+        for var, var_usages in role_usages.items():
+            if var in role_vars or var in role_defaults or var in pbook_vars or var in pbook_inventory or \
+                    var in role_declared or var in ANSIBLE_VARIABLES or var.startswith('ansible_'):
+                continue
+            f, line = var_usages[0]
+            role_issues['used-but-undeclared'].append(Issue('used-but-undeclared', var, f, role_dir, line=line))
+    return role_issues
+
 
 #
-# Show results
+# Collect and check the role, either in this process or in a worker of the pool
 #
-if issues_count > 0:
-    if not args.quiet:
+#   Returns everything collected, issues per playbook including the role and
+#   cache entries used, so the pool's results can be merged by the parent.
+#
+def check_role(role_dir, role_pbooks):
+    cache['touched'] = set()
+    scanned_entries.clear()
+    with phase('scan'):
+        role_files, scanned = collect_files(role_dir)
+    role_data = {
+        'tasks': [],
+        'variables': {'vars': {}, 'defaults': {}, 'readme': {}},
+        'usages': ({}, set()),
+        'warnings': [],
+        'scanned': scanned,
+        'dependencies': [],
+    }
+    if args.become:
+        with phase('tasks'):
+            role_data['tasks'] = collect_tasks(role_dir, role_files, role_data['warnings'], role_data['dependencies'])
+    if args.consistency or args.usage:
+        with phase('variables'):
+            role_data['variables'] = collect_variables(role_files, role_data['warnings'])
+    if args.usage:
+        with phase('usages'):
+            role_data['usages'] = collect_usages(role_files)
+    with phase('issues'):
+        role_issues = {pbook: find_issues(pbook, pbook_vars, role_dir, role_data) for pbook, pbook_vars in role_pbooks}
+    return role_files, role_data, role_issues, {f: cache['entries'][f] for f in cache['touched']}
+
+def check_role_pooled(role_dir, role_pbooks):
+    profile_reset()
+    return check_role(role_dir, role_pbooks), {k: v for k, v in profile.items() if k != 'cprofile'}
+
+
+#
+# Report issues
+#
+#   Issues of every role are written out as soon as the role is checked and
+#   counted as they are, the total is known without going over them again.
+#
+#      +--------+-------------------------------------------------------+
+#      | Format | Output                                                |
+#      |--------+-------------------------------------------------------|
+#      | text   | issues grouped by role and kind, warnings inline      |
+#      | jsonl  | JSON object per issue, warnings to stderr             |
+#      | sarif  | SARIF 2.1.0 log, results are streamed into its single |
+#      |        | run and the log is closed once all roles are checked  |
+#      +--------+-------------------------------------------------------+
+#
+ISSUE_TITLES = {
+    'in-role_not-in-playbook': 'Declared in the role, but missing in the playbook',
+    'in-playbook_not-in-role': 'Declared in the playbook, but undeclared in the role',
+    'overwrites_defaults': 'Declared in the playbook and are overwriting defaults',
+    # Readme
+    'in-role_not-in-readme': 'Declared in the role, but absent in its README.md',
+    'in-readme_not-in-role': 'Declared in the README.md, but absent in the role',
+    'in-readme_not-in-playbook': 'Declared in the README.md, but absent in the playbook',
+    # Type mismatch
+    'type_mismatch': 'Type mismatch between the playbook and role',
+    # Noname
+    'tasks_without_names': 'Nameless tasks',
+    # Become-no-user
+    'become_without_become-user': '`become` without explicitly set `become_user`',
+    # Become-no-become
+    'become-user_without_become': '`become_user` without `become` set to True',
+    # Usages
+    'declared-but-unused': 'Declared in the role, but never used in its tasks, vars or templates',
+    'used-but-undeclared': 'Used in the role, but declared neither in it, nor the playbook or inventory',
+}
+SARIF_SCHEMA = 'https://json.schemastore.org/sarif-2.1.0.json'
+
+reported = {'count': 0, 'results': 0}
+
+def role_header(pbook, role):
+    if len(collected['playbooks']) > 1:
+        return '\n\033[92m[%s: %s]\033[0m' % (os.path.basename(pbook), role)
+    return '\n\033[92m[%s]\033[0m' % role
+
+def issue_record(pbook, role, issue):
+    return {
+        'playbook': pbook,
+        'role': role,
+        'kind': issue.kind,
+        'name': issue.name,
+        'file': os.path.relpath(issue.file),
+        'task': issue.task,
+        'tasks': issue.tasks,
+        'line': issue.line,
+    }
+
+def sarif_result(pbook, role, issue):
+    location = {'artifactLocation': {'uri': os.path.relpath(issue.file).replace(os.sep, '/')}}
+    if issue.line is not None:
+        location['region'] = {'startLine': issue.line}
+    return {
+        'ruleId': issue.kind,
+        'level': 'warning',
+        'message': {'text': '%s: %s' % (ISSUE_TITLES[issue.kind], issue)},
+        'locations': [{
+            'physicalLocation': location,
+            'logicalLocations': [{'name': role, 'kind': 'module'}],
+        }],
+        'properties': {'playbook': pbook, 'task': issue.task, 'tasks': issue.tasks},
+    }
+
+def report_start():
+    if args.format == 'sarif' and not args.quiet:
+        rules = [{'id': issue, 'shortDescription': {'text': title}} for issue, title in ISSUE_TITLES.items()]
+        sys.stdout.write('{"$schema": %s, "version": "2.1.0", "runs": [{"tool": {"driver": %s}, "results": [' % (
+            json.dumps(SARIF_SCHEMA), json.dumps({'name': 'ansible-sanity', 'rules': rules})
+        ))
+
+def report_warning(warning):
+    print(warning, file=sys.stdout if args.format == 'text' else sys.stderr)
+
+def report_role(pbook, role):
+    role_issues = collected['issues'][pbook][role]
+    reported['count'] += sum(len(issues) for issues in role_issues.values())
+    if args.quiet:
+        return
+    if args.format == 'text':
         stdout = []
-        for role in collected['issues']:
-            # Role/playbook
-            for issue in collected['issues'][role].keys():
-                if len(collected['issues'][role][issue]) > 0:
-                    stdout.append('\n\033[92m[%s]\033[0m' % role)
-                    break
-            if len(collected['issues'][role]['in-role_not-in-playbook']) > 0:
-                stdout.append('\nDeclared in the role, but missing in the playbook:\n')
-                for var in collected['issues'][role]['in-role_not-in-playbook']:
-                    stdout.append('   - %s' % var)
-            if len(collected['issues'][role]['in-playbook_not-in-role']) > 0:
-                stdout.append('\nDeclared in the playbook, but undeclared in the role:\n')
-                for var in collected['issues'][role]['in-playbook_not-in-role']:
-                    stdout.append('   - %s' % var)
-            if len(collected['issues'][role]['overwrites_defaults']) > 0:
-                stdout.append('\nDeclared in the playbook and are overwriting defaults:\n')
-                for var in collected['issues'][role]['overwrites_defaults']:
-                    stdout.append('   - %s' % var)
-            # Readme
-            if len(collected['issues'][role]['in-role_not-in-readme']) > 0:
-                stdout.append('\nDeclared in the role, but absent in its README.md:\n')
-                for var in collected['issues'][role]['in-role_not-in-readme']:
-                    stdout.append('   - %s' % var)
-            if len(collected['issues'][role]['in-readme_not-in-role']) > 0:
-                stdout.append('\nDeclared in the README.md, but absent in the role:\n')
-                for var in collected['issues'][role]['in-readme_not-in-role']:
-                    stdout.append('   - %s' % var)
-            if len(collected['issues'][role]['in-readme_not-in-playbook']) > 0:
-                stdout.append('\nDeclared in the README.md, but absent in the playbook:\n')
-                for var in collected['issues'][role]['in-readme_not-in-playbook']:
+        # Role/playbook
+        if any(role_issues.values()):
+            stdout.append(role_header(pbook, role))
+        for issue, title in ISSUE_TITLES.items():
+            if len(role_issues[issue]) > 0:
+                stdout.append('\n%s:\n' % title)
+                for var in role_issues[issue]:
                     stdout.append('   - %s' % var)
-            # Type mismatch
-            if len(collected['issues'][role]['type_mismatch']) > 0:
-                stdout.append('\nType mismatch between the playbook and role:\n')
-                for var in collected['issues'][role]['type_mismatch']:
-                    stdout.append('   - %s' % var)
-            # Noname
-            if len(collected['issues'][role]['tasks_without_names']) > 0:
-                stdout.append('\nNameless tasks:\n')
-                for var in collected['issues'][role]['tasks_without_names']:
-                    stdout.append('   - %s' % var)
-            # Become-no-user
-            if len(collected['issues'][role]['become_without_become-user']) > 0:
-                stdout.append('\n`become` without explicitly set `become_user`:\n')
-                for var in collected['issues'][role]['become_without_become-user']:
-                    stdout.append('   - %s' % var)
-            # Become-no-become
-            if len(collected['issues'][role]['become-user_without_become']) > 0:
-                stdout.append('\n`become_user` without `become` set to True:\n')
-                for var in collected['issues'][role]['become-user_without_become']:
-                    stdout.append('   - %s' % var)
-        stdout.append('\n\033[91m%s issues in total.\033[0m\n' % issues_count)
-        print(*stdout, sep='\n')
+        if stdout:
+            print(*stdout, sep='\n')
+    else:
+        for issue in ISSUE_TITLES:
+            for role_issue in role_issues[issue]:
+                if args.format == 'jsonl':
+                    sys.stdout.write(json.dumps(issue_record(pbook, role, role_issue)) + '\n')
+                else:
+                    sys.stdout.write(',' if reported['results'] else '')
+                    sys.stdout.write(json.dumps(sarif_result(pbook, role, role_issue)))
+                    reported['results'] += 1
+    sys.stdout.flush()
+
+def report_end():
+    if args.quiet:
+        print(reported['count'])
+    elif args.format == 'text' and reported['count'] > 0:
+        print('\n\033[91m%s issues in total.\033[0m\n' % reported['count'])
+    elif args.format == 'sarif':
+        sys.stdout.write(']}]}\n')
+        sys.stdout.flush()
+
+
+#
+# Parse playbooks, every role is collected once regardless of how many of them include it
+#
+for pbook in pbooks:
+    with phase('playbooks'):
+        pbook_roles = load_playbook(pbook)
+    if pbook_roles is None:
+        continue
+    collected['playbooks'][pbook] = pbook_roles
+    if len(pbook_roles) == 0:
+        noroles(pbook)
+
+roles_pbooks: dict = {}
+roles_refs: dict = {}
+for pbook in collected['playbooks']:
+    collected['issues'][pbook] = {}
+    for role in collected['playbooks'][pbook]:
+        roles_pbooks.setdefault(role_path(pbook, role), []).append((pbook, collected['playbooks'][pbook][role]))
+        roles_refs.setdefault(role_path(pbook, role), []).append((pbook, role))
+if not roles_pbooks:
+    os._exit(os.EX_DATAERR)
+roles_referenced = set(roles_pbooks)
+
+
+#
+# Check only the changed roles, with `--changed-since` or `--staged`
+#
+#   Paths listed by `git diff --name-only` of every repository the playbooks
+#   are in are mapped onto the roles by their directories. Roles of changed
+#   playbooks are checked as a whole, as their vars may have changed. Nothing
+#   else is collected or parsed, so time taken doesn't depend on repository
+#   size, only on the size of the change.
+#
+def changed_paths():
+    git_diff = ['git', 'diff', '--name-only', '-z']
+    if args.staged:
+        git_diff.append('--cached')
+    if args.changed_since:
+        git_diff.append(args.changed_since)
+    paths = set()
+    toplevels = set()
+    for pbook_dir in {os.path.dirname(os.path.abspath(pbook)) for pbook in pbooks}:
+        try:
+            toplevel = subprocess.run(['git', 'rev-parse', '--show-toplevel'], cwd=pbook_dir,
+                                      capture_output=True, text=True, check=True).stdout.strip()
+            if toplevel in toplevels:
+                continue
+            toplevels.add(toplevel)
+            git_diff_output = subprocess.run(git_diff + ['--'], cwd=toplevel,
+                                             capture_output=True, text=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError) as exc:
+            badgit(exc)
+        paths.update(os.path.join(toplevel, path) for path in git_diff_output.split('\0') if path)
+    return paths
+
+if args.changed_since or args.staged:
+    with phase('changed'):
+        roles_real = {os.path.realpath(role_dir): role_dir for role_dir in roles_pbooks}
+        pbooks_real = {os.path.realpath(pbook): pbook for pbook in collected['playbooks']}
+        inventories_real = {}
+        for pbook in collected['playbooks']:
+            for inventory_dir in INVENTORY_DIRS:
+                inventory_real = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(pbook)), inventory_dir))
+                inventories_real.setdefault(inventory_real + os.sep, []).append(pbook)
+        roles_changed = set()
+        for path in changed_paths():
+            if path in pbooks_real:
+                pbook = pbooks_real[path]
+                roles_changed.update(role_path(pbook, role) for role in collected['playbooks'][pbook])
+                continue
+            # Inventory is of every playbook next to it
+            path_inventory = next((d for d in inventories_real if path.startswith(d)), None)
+            if path_inventory:
+                for pbook in inventories_real[path_inventory]:
+                    roles_changed.update(role_path(pbook, role) for role in collected['playbooks'][pbook])
+                continue
+            path_dir = os.path.dirname(path)
+            while path_dir not in roles_real and os.path.dirname(path_dir) != path_dir:
+                path_dir = os.path.dirname(path_dir)
+            if path_dir in roles_real:
+                roles_changed.add(roles_real[path_dir])
+        roles_pbooks = {role_dir: roles_pbooks[role_dir] for role_dir in roles_pbooks if role_dir in roles_changed}
+        roles_refs = {role_dir: roles_refs[role_dir] for role_dir in roles_refs if role_dir in roles_changed}
+
+
+
+#
+# Index variables of the inventory next to the playbooks
+#
+#   Files of `group_vars/` and `host_vars/` beside every playbook of the roles
+#   to check, as well as files in their subdirectories, are collected once per
+#   directory. Their top-level variables are indexed along with the files
+#   setting them, so these are not reported as missing in the playbook, files
+#   encrypted with Ansible Vault as a whole set none. Files are parsed in `-j`
+#   processes and cached the same way role files are.
+#
+def scan_inventory(path, found):
+    try:
+        with os.scandir(path) as dir_entries:
+            for entry in sorted(dir_entries, key=lambda e: e.name):
+                profile['dir_entries'] += 1
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    scan_inventory(entry.path, found)
+                elif entry.is_file() and (entry.name.endswith(INVENTORY_EXTENSIONS) or '.' not in entry.name):
+                    found.append(entry.path)
+                    scanned_entries[entry.path] = entry
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+
+def inventory_fact(f):
+    try:
+        return file_facts(f, 'inventory')
+    except YAMLError:
+        # Reported as invalid along with the empty ones, there is nothing to cache
+        cache['touched'].discard(('inventory', os.path.abspath(f)))
+        return None
+
+def inventory_facts(inventory_files):
+    cache['touched'] = set()
+    return [inventory_fact(f) for f in inventory_files], {f: cache['entries'][f] for f in cache['touched']}
+
+def inventory_facts_pooled(inventory_files):
+    profile_reset()
+    return inventory_facts(inventory_files), {k: v for k, v in profile.items() if k != 'cprofile'}
+
+def index_inventory():
+    inventory_dirs = {}
+    # Only next to the playbooks of roles to check, all of them unless changed ones are
+    for pbook in dict.fromkeys(pbook for role_refs in roles_refs.values() for pbook, _ in role_refs):
+        inventory_dirs.setdefault(os.path.dirname(os.path.abspath(pbook)), [])
+    for pbook_dir, inventory_files in inventory_dirs.items():
+        for inventory_dir in INVENTORY_DIRS:
+            scan_inventory(os.path.join(pbook_dir, inventory_dir), inventory_files)
+    inventory_files = list(chain.from_iterable(inventory_dirs.values()))
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    chunks = [inventory_files[i:i + 256] for i in range(0, len(inventory_files), 256)]
+    if jobs > 1 and len(chunks) > 1 and 'fork' in get_all_start_methods() and not args.profile_phase:
+        # Forked workers inherit parsed arguments, loaded cache and scanned entries
+        with ProcessPoolExecutor(min(jobs, len(chunks)), mp_context=get_context('fork')) as pool:
+            chunks_facts = []
+            for chunk_facts, chunk_profile in pool.map(inventory_facts_pooled, chunks):
+                chunks_facts.append(chunk_facts)
+                profile_merge(chunk_profile)
+    else:
+        chunks_facts = list(map(inventory_facts, chunks))
+    inventory_facts_all = []
+    for chunk_facts, cache_entries in chunks_facts:
+        inventory_facts_all.extend(chunk_facts)
+        cache['entries'].update(cache_entries)
+        cache['by_hash'].update({(e['type'], e['hash']): e['facts'] for e in cache_entries.values()})
+    inventory_facts_all = iter(inventory_facts_all)
+    for pbook_dir, inventory_files in inventory_dirs.items():
+        pbook_inventory = collected['inventory'][pbook_dir] = {}
+        for f, var_facts in zip(inventory_files, inventory_facts_all):
+            if var_facts is None:
+                report_warning('WARNING: %s has no valid YAML content' % os.path.relpath(f))
+                continue
+            for var, var_type in var_facts:
+                pbook_inventory.setdefault(var, []).append((f, var_type))
+
+if args.consistency or args.usage:
+    with phase('inventory'):
+        index_inventory()
+
+def checked_roles():
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    if jobs > 1 and len(roles_pbooks) > 1 and 'fork' in get_all_start_methods() and not args.profile_phase:
+        # Forked workers inherit parsed arguments and loaded cache
+        with ProcessPoolExecutor(min(jobs, len(roles_pbooks)), mp_context=get_context('fork')) as pool:
+            for role_checked, role_profile in pool.map(check_role_pooled, roles_pbooks.keys(), roles_pbooks.values(),
+                                                       chunksize=max(1, len(roles_pbooks) // (jobs * 4))):
+                profile_merge(role_profile)
+                yield role_checked
+    else:
+        yield from map(check_role, roles_pbooks.keys(), roles_pbooks.values())
+
+#
+# Issues in tasks of dependency roles belong to the first role depending on them
+#
+#   Every role walks its dependencies on its own, the same task of a role many
+#   others depend on would be reported with each of them. Ownership is taken
+#   as results are merged, in the order roles were referenced, hence is the
+#   same however many processes checked them. A role shared between playbooks
+#   reports them with each playbook, as it does its own issues.
+#
+dependency_owners: dict = {}
+
+def own_dependency_issues(role_dir, role_issues):
+    for pbook_issues in role_issues.values():
+        for issue, issues in pbook_issues.items():
+            pbook_issues[issue] = [
+                v for v in issues if v.task is None or v.file.startswith(role_dir + os.sep)
+                or dependency_owners.setdefault((issue, v.file, v.task), role_dir) == role_dir
+            ]
+    return role_issues
+
+# Merge and report in the order roles were referenced, output is the same as of a serial run
+report_start()
+warned = set()
+for role_dir, (role_files, role_data, role_issues, cache_entries) in zip(roles_pbooks, checked_roles()):
+    collected['files'][role_dir] = role_files
+    collected['roles'][role_dir] = role_data
+    cache['entries'].update(cache_entries)
+    cache['by_hash'].update({(e['type'], e['hash']): e['facts'] for e in cache_entries.values()})
+    # Warnings of dependency roles come with every role depending on them
+    for warning in role_data['warnings']:
+        if warning not in warned:
+            warned.add(warning)
+            report_warning(warning)
+    role_issues = own_dependency_issues(role_dir, role_issues)
+    with phase('report'):
+        for pbook, role in roles_refs[role_dir]:
+            collected['issues'][pbook][role] = role_issues[pbook]
+            report_role(pbook, role)
+with phase('report'):
+    report_end()
+
+
 #
-# `-q` flag, single integer output
+# Watch roles, re-check only the changed ones
 #
-if args.quiet:
-    print(issues_count)
+#   Files and directories collected for every role, and for the dependency
+#   roles it walks, are polled for changed mtime or size. Directories are
+#   included, so added and removed files are noticed too. Unchanged files of
+#   the role are served from the in-memory cache, only the edited one is
+#   parsed again.
+#
+def watch_snapshot(role_dir):
+    snapshot = {}
+    role_data = collected['roles'][role_dir]
+    for path in chain(role_data['scanned']['dirs'], role_data['dependencies'], *collected['files'][role_dir].values()):
+        try:
+            path_stat = os.stat(path)
+            snapshot[path] = (path_stat.st_mtime_ns, path_stat.st_size)
+        except OSError:
+            snapshot[path] = None
+    return snapshot
+
+def watch_key(issue):
+    # Number of tasks in the file and lines of usages change along with any edit
+    # of it, these are rendered anew with the issues added, not compared
+    return issue.kind, issue.file, issue.task, issue.name
+
+def watch_recheck(role_dir):
+    started = perf_counter()
+    # Walked files are parsed again only if they have changed, but are checked anew
+    for walked in task_graph.values():
+        walked.clear()
+    try:
+        role_files, role_data, role_issues, cache_entries = check_role(role_dir, roles_pbooks[role_dir])
+    except YAMLError as exc:
+        report_warning('Unable to parse a file of %s:\n\t%s' % (role_dir, exc))
+        return False
+    role_issues = own_dependency_issues(role_dir, role_issues)
+    collected['files'][role_dir] = role_files
+    collected['roles'][role_dir] = role_data
+    for warning in role_data['warnings']:
+        report_warning(warning)
+    stdout = []
+    for pbook, role in roles_refs[role_dir]:
+        role_issues_old = collected['issues'][pbook][role]
+        collected['issues'][pbook][role] = role_issues[pbook]
+        role_delta = []
+        for issue, title in ISSUE_TITLES.items():
+            issue_old = set(map(watch_key, role_issues_old[issue]))
+            issue_new = set(map(watch_key, role_issues[pbook][issue]))
+            removed = [v for v in role_issues_old[issue] if watch_key(v) not in issue_new]
+            added = [v for v in role_issues[pbook][issue] if watch_key(v) not in issue_old]
+            reported['count'] += len(added) - len(removed)
+            if args.format == 'jsonl':
+                role_delta.extend(json.dumps({'change': 'removed', **issue_record(pbook, role, v)}) for v in removed)
+                role_delta.extend(json.dumps({'change': 'added', **issue_record(pbook, role, v)}) for v in added)
+            else:
+                role_delta.extend('   - %s: %s' % (title, v) for v in removed)
+                role_delta.extend('   + %s: %s' % (title, v) for v in added)
+        if role_delta and args.format == 'text':
+            stdout.append(role_header(pbook, role) + ' re-checked in %.1fms\n' % ((perf_counter() - started) * 1000))
+        stdout.extend(role_delta)
+    if stdout:
+        if args.quiet:
+            print(reported['count'])
+        elif args.format == 'jsonl':
+            print(*stdout, sep='\n')
+        else:
+            stdout.append('\n\033[91m%s issues in total.\033[0m\n' % reported['count'])
+            print(*stdout, sep='\n')
+        sys.stdout.flush()
+    return True
+
+def watch():
+    snapshots = {role_dir: watch_snapshot(role_dir) for role_dir in roles_pbooks}
+    while True:
+        sleep(args.watch_interval)
+        for role_dir in roles_pbooks:
+            snapshot = watch_snapshot(role_dir)
+            if snapshot != snapshots[role_dir] and watch_recheck(role_dir):
+                snapshot = watch_snapshot(role_dir)
+            snapshots[role_dir] = snapshot
+
+
+if args.watch:
+    try:
+        watch()
+    except KeyboardInterrupt:
+        pass
+with phase('cache'):
+    cache_save()
+show_profile()
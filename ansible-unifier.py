@@ -5,13 +5,32 @@
 
 import os
 import re
+import sys
+import json
 import argparse
+from difflib import unified_diff
+from hashlib import sha1
+from tempfile import mkstemp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+
+from yaml import YAMLError
+from yaml.events import (AliasEvent, MappingEndEvent, MappingStartEvent, ScalarEvent, SequenceEndEvent,
+                         SequenceStartEvent, StreamEndEvent)
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 
 parser = argparse.ArgumentParser(prog='ansible-unifier',
                                  description='Unifies quotation and booleans in a way that doesn\'t explode')
 parser.add_argument('-d', '--dir', help="Path to the ../roles/ directory")
 parser.add_argument('-q', '--quiet', action='store_true', help="Output nothing except of the issues count")
+parser.add_argument('--diff', action='store_true', help="Output unified diff instead of re-writing files")
+parser.add_argument('-j', '--jobs', type=int, default=1, help="Unify files in N processes, 0 for one per CPU")
+parser.add_argument('--cache-dir', default='.ansible-sanity-cache', help="Directory of the manifest of unified files")
+parser.add_argument('--no-cache', action='store_true', help="Unify every file, ignore and keep the manifest intact")
 args = parser.parse_args()
 
 
@@ -29,44 +48,199 @@ for root, dirs, files in os.walk(args.dir):
             ymls.append(os.path.join(root, f))
 
 
-for f in ymls:
+#
+# Manifest of unified files
+#
+#   Content hash of every file left unified, keyed by the absolute path. Files
+#   with unchanged size and mtime are skipped without being read, files with
+#   unchanged content without being unified.
+#
+MANIFEST_VERSION = 3
+manifest_path = os.path.join(args.cache_dir, 'unified.json')
+manifest = {}
+if not args.no_cache:
+    try:
+        with open(manifest_path, 'r') as mop:
+            manifest_loaded = json.load(mop)
+        if manifest_loaded.get('version') == MANIFEST_VERSION:
+            manifest = manifest_loaded['files']
+    except (OSError, ValueError, AttributeError, KeyError):
+        pass
+
+
+#
+# Unify quotation and booleans of mapping values
+#
+#   Walks events of the YAML parser once, so comments, keys, block scalars,
+#   tagged and anchored values are never touched. Returns the text with edits
+#   applied to character ranges of the affected scalars only.
+#
+#    - "double-quoted" single-line values without escapes become 'single-quoted'.
+#      Single quotes inside Jinja expressions are swapped for double quotes,
+#      values with single quotes anywhere else are left alone.
+#    - Plain yes/no and on/off in any case become True/False.
+#
+BOOLEANS = {
+    'yes': 'True', 'Yes': 'True', 'YES': 'True', 'on': 'True', 'On': 'True', 'ON': 'True',
+    'no': 'False', 'No': 'False', 'NO': 'False', 'off': 'False', 'Off': 'False', 'OFF': 'False',
+}
+JINJA_SPANS = re.compile(r'{{.*?}}|{%.*?%}', re.DOTALL)
+
+def unify_quoted(event, text):
+    source = text[event.start_mark.index:event.end_mark.index]
+    if event.start_mark.line != event.end_mark.line or '\\' in source:
+        return None
+    value = event.value
+    if "'" in value:
+        if '"' in value or "'" in JINJA_SPANS.sub('', value):
+            return None
+        value = JINJA_SPANS.sub(lambda span: span.group().replace("'", '"'), value)
+    return "'%s'" % value
+
+# Every edited scalar is a mapping value, hence follows a colon. Most files
+# have none of these, such files are never parsed.
+CANDIDATES = re.compile(r':\s*(?:"|(?:%s)\b)' % '|'.join(BOOLEANS))
+
+NODE_EVENTS = frozenset((AliasEvent, ScalarEvent, MappingStartEvent, SequenceStartEvent))
+COLLECTION_END_EVENTS = frozenset((MappingEndEvent, SequenceEndEvent))
+
+def unify(text):
+    if not CANDIDATES.search(text):
+        return text, False
+    edits = []
+    # Per collection being parsed: number of nodes in a mapping, -1 for a sequence
+    nodes = []
+    loader = SafeLoader(text)
+    try:
+        event = loader.get_event()
+        while type(event) is not StreamEndEvent:
+            event_type = type(event)
+            if event_type in NODE_EVENTS:
+                in_value = bool(nodes) and nodes[-1] > 0 and nodes[-1] % 2 == 1
+                if nodes and nodes[-1] >= 0:
+                    nodes[-1] += 1
+                if event_type is MappingStartEvent:
+                    nodes.append(0)
+                elif event_type is SequenceStartEvent:
+                    nodes.append(-1)
+                elif in_value and event_type is ScalarEvent and event.tag is None and event.anchor is None:
+                    if event.style == '"':
+                        replacement = unify_quoted(event, text)
+                    elif not event.style:
+                        replacement = BOOLEANS.get(event.value)
+                    else:
+                        replacement = None
+                    if replacement is not None:
+                        edits.append((event.start_mark.index, event.end_mark.index, replacement))
+            elif event_type in COLLECTION_END_EVENTS:
+                nodes.pop()
+            event = loader.get_event()
+    finally:
+        loader.dispose()
+    if not edits:
+        return text, False
+    unified = []
+    position = 0
+    for start, end, replacement in edits:
+        unified.append(text[position:start])
+        unified.append(replacement)
+        position = end
+    unified.append(text[position:])
+    return ''.join(unified), True
+
+
+#
+# Unify a single file, either in this process or in a worker of the pool
+#
+#   Rewritten content goes to a temporary file next to the original, which
+#   then replaces it, so an interrupted run never leaves a truncated YAML.
+#   Symlinks are resolved, it's the file they point to that is replaced, and
+#   the mode, owner and group are carried over as far as permissions allow.
+#   Returns whether file was changed, its manifest entry and either a warning
+#   or, with `--diff`, the diff to output.
+#
+def unify_file(f):
+    f_stat = os.stat(f)
+    entry = manifest.get(os.path.abspath(f))
+    if entry and entry['size'] == f_stat.st_size and entry['mtime'] == f_stat.st_mtime_ns:
+        return False, entry, None
+    with open(f, 'rb') as fop:
+        content = fop.read()
+    content_hash = sha1(content).hexdigest()
     f_changed = False
-    with open(f, 'r+') as fop:
-        f_lines = fop.readlines()
-        f_newlines = []
-        for ln in f_lines:
-            if '"' in ln:
-                ln_match = re.search(r'(.+)(\w:\s+)(\")(.+?)(\")(.*)', ln)
-                if ln_match:
-                    if len(ln_match.groups()) == 6:
-                        oldline = list(ln_match.groups())
-                        if "'" in oldline[3]:
-                            oldline[3] = re.sub(r"'", '"', oldline[3])
-                        oldline[2] = oldline[4] = "'"
-                        oldline_last = ''.join(oldline[-1:])
-                        if not oldline_last.endswith('\n'):
-                            oldline[-1:] = oldline_last + '\n'
-                        [str(x) for x in oldline]
-                        ln = ''.join(oldline)
-                        f_changed = True
-            for repl in (('yes', 'True'), ('no', 'False')):
-                if repl[0] in ln.lower():
-                    ln_orig = ln
-                    ln = re.sub(r': %s$' % (repl[0]), ': %s' % (repl[1]), ln)
-                    if ln != ln_orig:
-                        f_changed = True
-            f_newlines.append(ln)
-        if f_changed:
-            fop.seek(0, 0)
-            fop.truncate()
-            fop.writelines(f_newlines)
-            fop.close()
-            ymls_changed += 1
-            if not args.quiet:
-                print('Re-writing ../%s' % os.path.relpath(fop.name, args.dir))
+    if not entry or entry['hash'] != content_hash:
+        try:
+            text = content.decode('utf-8')
+            unified, f_changed = unify(text)
+        except (UnicodeDecodeError, YAMLError) as exc:
+            return False, None, 'WARNING: Unable to unify ../%s: %s' % (os.path.relpath(f, args.dir), exc)
+    if f_changed and args.diff:
+        rel = os.path.relpath(f, args.dir)
+        return True, None, ''.join(
+            unified_diff(text.splitlines(True), unified.splitlines(True), 'a/%s' % rel, 'b/%s' % rel)
+        )
+    if f_changed:
+        content = unified.encode('utf-8')
+        content_hash = sha1(content).hexdigest()
+        f_real = os.path.realpath(f)
+        tmp_fd, tmp_path = mkstemp(dir=os.path.dirname(f_real), prefix='.%s.' % os.path.basename(f_real),
+                                   suffix='.tmp')
+        try:
+            with os.fdopen(tmp_fd, 'wb') as top:
+                top.write(content)
+            try:
+                os.chown(tmp_path, f_stat.st_uid, f_stat.st_gid)
+            except OSError:
+                # Unprivileged users may only keep the group, if they belong to it
+                try:
+                    os.chown(tmp_path, -1, f_stat.st_gid)
+                except OSError:
+                    pass
+            os.chmod(tmp_path, f_stat.st_mode & 0o7777)
+            os.replace(tmp_path, f_real)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        f_stat = os.stat(f)
+    return f_changed, {'size': f_stat.st_size, 'mtime': f_stat.st_mtime_ns, 'hash': content_hash}, None
+
+
+#
+# Unify files, results are handled in order as soon as they are ready
+#
+def unified_files():
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    if jobs > 1 and len(ymls) > 1 and 'fork' in get_all_start_methods():
+        # Forked workers inherit parsed arguments and loaded manifest
+        with ProcessPoolExecutor(min(jobs, len(ymls)), mp_context=get_context('fork')) as pool:
+            yield from pool.map(unify_file, ymls, chunksize=max(1, len(ymls) // (jobs * 4)))
+    else:
+        yield from map(unify_file, ymls)
+
+
+for f, (f_changed, entry, message) in zip(ymls, unified_files()):
+    if entry:
+        manifest[os.path.abspath(f)] = entry
+    if message and not args.quiet:
+        sys.stdout.write(message if f_changed else message + '\n')
+        sys.stdout.flush()
+    if f_changed:
+        ymls_changed += 1
+        if not args.quiet and not args.diff:
+            print('Re-writing ../%s' % os.path.relpath(f, args.dir))
+
+
+if not args.no_cache:
+    try:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        with open(manifest_path + '.tmp', 'w') as mop:
+            json.dump({'version': MANIFEST_VERSION, 'files': manifest}, mop)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    except OSError as exc:
+        print('WARNING: Unable to write the manifest to %s: %s' % (args.cache_dir, exc))
 
 
 if ymls_changed > 0 and not args.quiet:
-    print('Unified %s YAMLs' % ymls_changed)
+    print('%s %s YAMLs' % ('Would unify' if args.diff else 'Unified', ymls_changed))
 elif args.quiet:
     print(ymls_changed)
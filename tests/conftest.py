@@ -0,0 +1,40 @@
+import ast
+import os
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+#
+# Load functions of the scripts without running them
+#
+#   Scripts parse arguments and do their work at the module level, hence
+#   only their imports, constants and the requested functions and classes
+#   are executed. Overrides replace what was imported before the rest is.
+#
+def load_script(script, functions, **overrides):
+    with open(os.path.join(ROOT, script), 'r') as f:
+        tree = ast.parse(f.read(), script)
+    imports = []
+    body = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            imports.append(node)
+        elif isinstance(node, ast.Try) and all(isinstance(n, (ast.Import, ast.ImportFrom)) for n in node.body):
+            imports.append(node)
+        elif isinstance(node, ast.Assign) and all(isinstance(t, ast.Name) and t.id.isupper() for t in node.targets):
+            body.append(node)
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in functions:
+            body.append(node)
+    namespace = {'__name__': script}
+    exec(compile(ast.Module(imports, []), script, 'exec'), namespace)
+    namespace.update(overrides)
+    exec(compile(ast.Module(body, []), script, 'exec'), namespace)
+    return namespace
+
+
+@pytest.fixture
+def script():
+    return load_script
@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+README = (
+    '# role\n\n'
+    '| Variable | Description | Default |\n'
+    '|----------|-------------|---------|\n'
+    '| foo      | `foo` var   | 42      |\n'
+    '| bar      | `bar` var   | "text"  |\n'
+    '| baz      | `baz` var   | [1, 2]  |\n'
+    '\n'
+    'Not a table\n'
+)
+
+
+@pytest.fixture
+def parse_facts(script):
+    sanity = script('ansible-sanity.py', ('parse_facts', 'readme_variables', 'readme_value'),
+                    args=SimpleNamespace(loader='fast'), profile={'literal_eval_fallbacks': 0})
+    return sanity['parse_facts']
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n', '\r'], ids=['LF', 'CRLF', 'CR'])
+def test_readme_line_endings(parse_facts, newline):
+    content = README.replace('\n', newline).encode('utf-8')
+    assert parse_facts(content, 'readme') == [('foo', 42), ('bar', 'text'), ('baz', [1, 2])]
@@ -0,0 +1,78 @@
+import pytest
+import yaml
+
+
+#
+# The top-level scan of vars/defaults must agree with the complete load
+#
+#   Documents the scan can't mirror return None and are loaded completely by
+#   `parse_facts`, hence None is always correct. Anything else must match
+#   keys and types of the complete load, in the same order.
+#
+SCANNED = {
+    'scalars': b'a: 1\nb: 1.5\nc: text\nd: yes\ne: ~\nf: 2021-01-01\ng: 2021-01-01 10:00:00\nh: "quoted"\n',
+    'nested': b'a:\n  b:\n    - 1\n    - {c: [2, 3]}\nd: [4, 5]\ne: {}\n',
+    'aliases': b'a: &x 1\nb: *x\nc: &y [1, 2]\nd: *y\ne: &z {k: v}\nf: *z\n',
+    'nested anchors': b'a:\n  b: &x text\n  c: &y [1]\n  d: &z {k: v}\ne: *x\nf: *y\ng: *z\n',
+    'duplicate keys': b'a: 1\nb: 2\na: text\n',
+    'typed keys': b'1: a\n1.5: b\ntrue: c\n~: d\n2021-01-01: e\n',
+    'flow mapping': b'{a: 1, b: [2], c: {d: 3}}\n',
+    'document markers': b'---\na: 1\n...\n',
+    'non-specific tag': b'a: ! 1\nb: ! [1]\n',
+    'jinja': b'a: "{{ b }}"\nb: \'{% if c %}d{% endif %}\'\n',
+    'block scalars': b'a: |\n  text\nb: >-\n  folded\n',
+    'vault': b'a: !vault |\n  $ANSIBLE_VAULT;1.1;AES256\n  6162\nb: &x !unsafe "{{ c }}"\nd: *x\n',
+}
+FALLBACK = {
+    'empty': b'',
+    'comment only': b'# nothing\n',
+    'scalar root': b'text\n',
+    'list root': b'- a\n- b\n',
+    'tagged value': b'a: !!str 1\nb: !!set {c}\n',
+    'unknown tag': b'a: !custom 1\nb: !vault [c]\n',
+    'nested tag': b'a:\n  b: !!int "1"\n',
+    'tagged root': b'!!map\na: 1\n',
+    'merge keys': b'base: &base {a: 1}\nchild:\n  <<: *base\n<<: *base\n',
+    'complex key': b'? [a, b]\n: 1\n',
+    'multiple documents': b'a: 1\n---\nb: 2\n',
+    'unknown alias': b'a: *x\n',
+    'invalid': b'a: [1, 2\n',
+}
+
+
+def complete_load(loader, content):
+    loaded = yaml.load(content, Loader=loader)
+    try:
+        return [(var, type(loaded[var])) for var in loaded]
+    except TypeError:
+        return None
+
+
+LOADERS = [yaml.SafeLoader] + ([yaml.CSafeLoader] if yaml.__with_libyaml__ else [])
+
+
+@pytest.fixture(params=LOADERS, ids=lambda loader: loader.__name__)
+def scan(request, script):
+    sanity = script('ansible-sanity.py', ('yaml_top_level_types', 'yaml_scan_top_level', 'AnsibleSafeLoader'),
+                    SafeLoader=request.param)
+    return sanity['AnsibleSafeLoader'], sanity['yaml_top_level_types']
+
+
+@pytest.mark.parametrize('content', SCANNED.values(), ids=SCANNED.keys())
+def test_scanned_as_loaded(scan, content):
+    loader, yaml_top_level_types = scan
+    scanned = yaml_top_level_types(content)
+    assert scanned is not None
+    assert scanned == complete_load(loader, content)
+
+
+@pytest.mark.parametrize('content', FALLBACK.values(), ids=FALLBACK.keys())
+def test_falls_back_to_complete_load(scan, content):
+    _, yaml_top_level_types = scan
+    assert yaml_top_level_types(content) is None
+
+
+def test_unknown_tags_loaded_as_plain(scan):
+    loader, _ = scan
+    content = b'a: !vault |\n  $ANSIBLE_VAULT;1.1;AES256\n  6162\nb: !custom [1, !x {c: 2}]\nd: !!int "3"\n'
+    assert yaml.load(content, Loader=loader) == {'a': '$ANSIBLE_VAULT;1.1;AES256\n6162\n', 'b': [1, {'c': 2}], 'd': 3}
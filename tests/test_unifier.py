@@ -0,0 +1,37 @@
+import pytest
+
+
+@pytest.fixture
+def unify(script):
+    return script('ansible-unifier.py', ('unify', 'unify_quoted'))['unify']
+
+
+@pytest.mark.parametrize('text, unified', [
+    ('a: "text"\n', "a: 'text'\n"),
+    ('a: yes\nb: Off\nc: [yes, no]\n', 'a: True\nb: False\nc: [yes, no]\n'),
+    ('a: "{{ b[\'c\'] }}"\n', 'a: \'{{ b["c"] }}\'\n'),
+    ('a: "{% if b == \'c\' %}d{% endif %}"\n', 'a: \'{% if b == "c" %}d{% endif %}\'\n'),
+    ('a: {b: "c", d: on}\n', "a: {b: 'c', d: True}\n"),
+    ('- a: "b"\n  c:\n    - "d"\n    - e: no\n', "- a: 'b'\n  c:\n    - \"d\"\n    - e: False\n"),
+], ids=['quoted', 'booleans', 'jinja expression', 'jinja statement', 'flow', 'nested'])
+def test_unified(unify, text, unified):
+    assert unify(text) == (unified, True)
+
+
+@pytest.mark.parametrize('text', [
+    # Single quotes outside of Jinja are never swapped
+    'a: "it\'s {{ foo }}"\n',
+    'a: "It\'s {{ \'x\' }}"\n',
+    'a: "{{ foo }} isn\'t"\n',
+    'a: "it\'s"\n',
+    # Escapes, multiple lines, keys, comments, block scalars, tags and anchors
+    'a: "b\\tc"\n',
+    'a: "b\n  c"\n',
+    '"a": \'b\'\nyes: True\n',
+    '# a: "b" and c: yes\nd: 1\n',
+    'a: |\n  b: "c"\nd: >\n  yes\n',
+    'a: !!str yes\nb: ! "c"\n',
+    'a: &b yes\nc: *b\n',
+])
+def test_left_alone(unify, text):
+    assert unify(text) == (text, False)
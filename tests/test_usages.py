@@ -0,0 +1,72 @@
+import pytest
+
+
+@pytest.fixture
+def usage_facts(script):
+    sanity = script('ansible-sanity.py', ('usage_facts', 'yaml_usages', 'jinja_usages', 'jinja_names'))
+    return sanity['usage_facts']
+
+
+def names(usages):
+    return [name for name, _ in usages]
+
+
+@pytest.mark.parametrize('template, used', [
+    ('{{ foo }}', ['foo']),
+    ('{{ foo.bar }} {{ foo["baz"] }}', ['foo']),
+    ('{{ foo | default(bar) | join(", ") }}', ['foo', 'bar']),
+    ('{{ foo is defined and bar is not none }}', ['foo', 'bar']),
+    ('{{ lookup("env", "HOME") }} {{ range(count) }}', ['count']),
+    ('{{ foo | default(omit, boolean=True) }}', ['foo', 'omit']),
+    ('{{ "text" ~ foo if cond else 1 }}', ['foo', 'cond']),
+    ('{%- if foo -%}{{ bar }}{%- endif %}', ['foo', 'bar']),
+    ('{% for key, value in items.items() %}{{ key }}{{ value }}{{ loop.index }}{% endfor %}', ['items']),
+    ('{% set total = base + 1 %}{{ total }}', ['base']),
+    ('{% macro row(cell) %}{{ cell }}{% endmacro %}{{ row(foo) }}', ['foo']),
+    ('{% with local = foo %}{{ local }}{% endwith %}', ['foo']),
+    ('{% include "file.j2" %}{% import "macros.j2" as macros %}{{ macros.x(y) }}', ['y']),
+    ('{# {{ commented }} #}{% raw %}{{ raw }}{% endraw %}{{ foo }}', ['foo']),
+    ('{{ true }} {{ None }} {{ 42 }} {{ "{{ quoted }}" }}', []),
+    ('{{ foo }}{{ foo }}', ['foo']),
+], ids=['name', 'attribute and item', 'filters', 'tests', 'functions', 'keyword argument', 'operators',
+        'statement', 'for', 'set', 'macro', 'with', 'include and import', 'comment and raw', 'literals', 'repeated'])
+def test_template_usages(usage_facts, template, used):
+    usages, declared = usage_facts(template.encode(), 'template')
+    assert names(usages) == used
+    assert declared == ()
+
+
+@pytest.mark.parametrize('yml, used, declared', [
+    ('- debug:\n    msg: "{{ foo }}"\n  when: bar and not baz\n', ['foo', 'bar', 'baz'], ()),
+    ('- command: ls\n  register: listing\n- debug:\n    var: listing\n  changed_when: listing.rc != 0\n',
+     ['listing'], ('listing',)),
+    ('- debug:\n    msg: "{{ element }}"\n  loop: "{{ items }}"\n  loop_control:\n    loop_var: element\n',
+     ['element', 'items'], ('element',)),
+    ('- set_fact:\n    fact_a: "{{ src }}"\n    cacheable: true\n', ['src'], ('fact_a',)),
+    ('- ansible.builtin.set_fact:\n    fact_b: 1\n', [], ('fact_b',)),
+    ('- debug:\n    msg: "{{ task_var }}"\n  vars:\n    task_var: "{{ outer }}"\n', ['task_var', 'outer'],
+     ('task_var',)),
+    ('- debug:\n    msg: plain text\n  when: "{{ templated }}"\n', ['templated'], ()),
+    ('- name: "{{ not_a_conditional }}"\n  debug: msg=x\n  until: "result is succeeded"\n',
+     ['not_a_conditional', 'result'], ()),
+    ('key: when\nother: register\n', [], ()),
+], ids=['expression and conditional', 'register', 'loop_var', 'set_fact', 'set_fact fqcn', 'vars', 'braced when',
+        'until', 'no jinja'])
+def test_yaml_usages(usage_facts, yml, used, declared):
+    usages, yml_declared = usage_facts(yml.encode(), 'usage')
+    assert names(usages) == used
+    assert yml_declared == declared
+
+
+@pytest.mark.parametrize('content, f_type, lines', [
+    ('line_1: "{{ a }}"\nline_2: "{{ b }}"\n', 'usage', [('a', 1), ('b', 2)]),
+    ('block: |\n  text\n  {{ a }}\n  {{ b }}\n', 'usage', [('a', 3), ('b', 4)]),
+    ('folded: >\n  {{ a }}\n', 'usage', [('a', 2)]),
+    ('flow: [1, "{{ a }}"]\nnested:\n  - key: "{{ b }}"\n', 'usage', [('a', 1), ('b', 3)]),
+    ('- when: a\n- when:\n    - b\n    - c\n', 'usage', [('a', 1), ('b', 3), ('c', 4)]),
+    ('{{ a }}\n\n{% if b %}\n{{ c }}{% endif %}\n', 'template', [('a', 1), ('b', 3), ('c', 4)]),
+    ('{# multi\nline #}\n{{ a }}\n', 'template', [('a', 3)]),
+], ids=['scalars', 'literal block', 'folded block', 'flow and nested', 'conditional list', 'template', 'comment'])
+def test_usage_lines(usage_facts, content, f_type, lines):
+    usages, _ = usage_facts(content.encode(), f_type)
+    assert list(usages) == lines